@@ -0,0 +1,190 @@
+# cached absorption corrections for vanadium.py
+# the correction only depends on the sample shape and material, the detector
+# geometry and the wavelength binning, which rarely change, so results are
+# kept on disk keyed on all of them. For a sphere at the origin the correction
+# only depends on scattering angle and wavelength, so AbsorptionCorrection is
+# run on a few pixels spanning the scattering angles and every other pixel is
+# interpolated from that table. Other shapes cache the full correction.
+# Corrections can optionally include the sample only multiple scattering
+# correction and can be made directly on Momentum bins (lambda = 2pi/k maps
+# the bins one to one), so the data never has to be converted to Wavelength.
+from mantid.simpleapi import *
+import numpy as np
+
+import os
+
+from cacheTools import fileHash, parsHash, saveCached
+
+#pixels interpolated (and created as one workspace) at once when filling a
+#correction
+blockSize = 16384
+
+def twoThetas(workspace, key, cacheDir):
+
+    #scattering angle of every spectrum (nan for monitors and spectra
+    #without detectors), read from CreateDetectorTable's columns and cached
+
+    cacheFile = os.path.join(cacheDir, 'two_theta_{}.npy'.format(key))
+    if os.path.exists(cacheFile):
+        return np.load(cacheFile)
+
+    CreateDetectorTable(InputWorkspace=workspace,
+                        DetectorTableWorkspace='__abs_detectors')
+    table = mtd['__abs_detectors']
+    two_theta = np.deg2rad(np.array(table.column('Theta'), dtype=float))
+    # 'no' for detectors, 'yes' for monitors and 'n/a' without detectors
+    two_theta[np.array(table.column('Monitor')) != 'no'] = np.nan
+    DeleteWorkspace(Workspace='__abs_detectors')
+
+    np.save(cacheFile, two_theta)
+    return two_theta
+
+def isSymmetric(geometry):
+
+    return geometry.get('Shape') == 'Sphere' and np.allclose(geometry.get('Center', [0,0,0]), 0)
+
+def correctionFactors(inputWorkspace, outputWorkspace, multipleScattering=False):
+
+    #AbsorptionCorrection, times the sample only MultipleScatteringCorrection
+    #if multipleScattering, on the bins of inputWorkspace. Wavelength inputs
+    #are used as they are, Momentum inputs are converted and the factors
+    #converted back
+
+    unit = mtd[inputWorkspace].getAxis(0).getUnit().unitID()
+    if unit not in ['Wavelength', 'Momentum']:
+        raise ValueError('absorption corrections need Wavelength or Momentum, not {}'.format(unit))
+
+    if unit == 'Momentum':
+        ConvertUnits(InputWorkspace=inputWorkspace, OutputWorkspace='__abs_input', Target='Wavelength')
+        inputWorkspace = '__abs_input'
+
+    AbsorptionCorrection(InputWorkspace=inputWorkspace, OutputWorkspace=outputWorkspace)
+
+    if multipleScattering:
+        MultipleScatteringCorrection(InputWorkspace=inputWorkspace,
+                                     Method='SampleOnly',
+                                     OutputWorkspace='__mult_corr')
+        Multiply(LHSWorkspace=outputWorkspace,
+                 RHSWorkspace='__mult_corr_sampleOnly',
+                 OutputWorkspace=outputWorkspace)
+        DeleteWorkspace(Workspace='__mult_corr_sampleOnly')
+
+    if unit == 'Momentum':
+        ConvertUnits(InputWorkspace=outputWorkspace, OutputWorkspace=outputWorkspace, Target='Momentum')
+        DeleteWorkspace(Workspace='__abs_input')
+
+def absorptionTable(inputWorkspace, two_theta, nAngles, multipleScattering=False):
+
+    #AbsorptionCorrection for the pixels closest to nAngles evenly spaced
+    #scattering angles, returns the angles and their corrections (in
+    #workspace index order, see sortedTable)
+
+    valid = np.flatnonzero(np.isfinite(two_theta))
+    grid = np.linspace(two_theta[valid].min(), two_theta[valid].max(), nAngles)
+    order = valid[np.argsort(two_theta[valid])]
+    nearest = np.clip(np.searchsorted(two_theta[order], grid), 0, len(order)-1)
+    indices = np.unique(order[nearest])
+
+    ExtractSpectra(InputWorkspace=inputWorkspace,
+                   WorkspaceIndexList=indices.tolist(),
+                   OutputWorkspace='__abs_subset')
+    correctionFactors('__abs_subset', '__abs_table', multipleScattering)
+
+    table = mtd['__abs_table'].extractY()
+    DeleteWorkspace(Workspace='__abs_subset')
+    DeleteWorkspace(Workspace='__abs_table')
+
+    return two_theta[indices], table
+
+def sortedTable(angles, values):
+
+    #table sorted by scattering angle for interpolation, pixels from
+    #different banks are picked in workspace index order which isn't angle
+    #order, and repeated angles are dropped as they'd give 0/0 weights
+
+    order = np.argsort(angles, kind='stable')
+    angles, values = angles[order], values[order]
+    keep = np.concatenate([[True], np.diff(angles) > 0])
+    return angles[keep], values[keep]
+
+def absorptionCorrection(inputWorkspace, outputWorkspace, geometry, material,
+                         calibrationFiles=[], cacheDir=None, nAngles=200,
+                         multipleScattering=False):
+
+    #equivalent of correctionFactors(inputWorkspace, outputWorkspace,
+    #multipleScattering) for a sample set with geometry and material (as
+    #passed to SetSample). The input must have common bins
+
+    if cacheDir is None:
+        correctionFactors(inputWorkspace, outputWorkspace, multipleScattering)
+        return
+
+    os.makedirs(cacheDir, exist_ok=True)
+
+    ws = mtd[inputWorkspace]
+    x = ws.readX(0)
+    unit = ws.getAxis(0).getUnit().unitID()
+
+    instrumentKey = parsHash(ws.getInstrument().getName(),
+                             [fileHash(calibrationFile) for calibrationFile in calibrationFiles],
+                             ws.getNumberHistograms())
+    key = parsHash(instrumentKey, geometry, material, unit, x.tolist(), nAngles, multipleScattering)
+
+    if not isSymmetric(geometry):
+        cacheFile = os.path.join(cacheDir, 'absorption_{}.nxs'.format(key))
+        if os.path.exists(cacheFile):
+            LoadNexusProcessed(Filename=cacheFile, OutputWorkspace=outputWorkspace)
+        else:
+            correctionFactors(inputWorkspace, outputWorkspace, multipleScattering)
+            saveCached(SaveNexusProcessed, outputWorkspace, cacheFile)
+        return
+
+    two_theta = twoThetas(inputWorkspace, instrumentKey, cacheDir)
+
+    cacheFile = os.path.join(cacheDir, 'absorption_{}.npz'.format(key))
+    if os.path.exists(cacheFile):
+        table = np.load(cacheFile)
+        angles, values = table['angles'], table['values']
+    else:
+        angles, values = absorptionTable(inputWorkspace, two_theta, nAngles, multipleScattering)
+        np.savez(cacheFile, angles=angles, values=values)
+    angles, values = sortedTable(angles, values)
+
+    #linear interpolation in scattering angle a block of pixels at a time,
+    #pixels without an angle get no correction. Each block is created as one
+    #workspace sharing the input's X, instrument and sample
+    blocks = []
+    for start in range(0, len(two_theta), blockSize):
+        block = two_theta[start:start+blockSize]
+        valid = np.isfinite(block)
+        y = np.ones((len(block), values.shape[1]))
+        if len(angles) == 1:
+            y[valid] = values[0]
+        else:
+            j = np.clip(np.searchsorted(angles, block[valid])-1, 0, len(angles)-2)
+            w = np.clip((block[valid]-angles[j])/(angles[j+1]-angles[j]), 0, 1)[:,None]
+            y[valid] = (1-w)*values[j]+w*values[j+1]
+
+        blocks.append('__abs_block{}'.format(len(blocks)))
+        CreateWorkspace(DataX=x,
+                        DataY=y.ravel(),
+                        DataE=np.zeros(y.size),
+                        NSpec=len(block),
+                        UnitX=unit,
+                        ParentWorkspace=inputWorkspace,
+                        OutputWorkspace=blocks[-1])
+
+    #joined pairwise so each spectrum is only moved log2(blocks) times, the
+    #joins share the histogram data rather than copying it
+    while len(blocks) > 1:
+        for first, second in zip(blocks[0::2], blocks[1::2]):
+            ConjoinWorkspaces(InputWorkspace1=first,
+                              InputWorkspace2=second,
+                              CheckOverlapping=False)
+        blocks = blocks[0::2]
+    RenameWorkspace(InputWorkspace=blocks[0], OutputWorkspace=outputWorkspace)
+
+    #the blocks don't have the input's spectrum to detector mapping
+    CopyDetectorMapping(WorkspaceToMatch=inputWorkspace,
+                        WorkspaceToRemap=outputWorkspace,
+                        IndexBySpectrumNumber=False)
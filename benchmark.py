@@ -0,0 +1,458 @@
+# offline benchmarks for the calibration and vanadium pipelines
+# synthetic event NeXus files are generated locally (Bragg peaks of a known
+# crystal plus background on SNAP/TOPAZ, and an incoherent vanadium-like
+# spectrum), so no /SNS data is needed. The pipelines run the same modules as
+# calibrate.py and vanadium.py (peakFinding, panelRefinement,
+# vanadiumCorrections, fluxFit), so changes to them show up in the results.
+# Each pipeline step is timed for every combination of event and run counts,
+# and inside the modules the main algorithms (ConvertToMD, FindPeaksMD,
+# IntegratePeaksMD, SCDCalibratePanels, ...) are timed separately through
+# stageTrace, so a comparison shows which step changed. The results are
+# written as json, which can be compared against an earlier result file, and
+# the full trace next to it (<results>_trace.json).
+#
+# usage: python benchmark.py [results.json]
+#        python benchmark.py --compare old.json new.json
+from mantid.simpleapi import *
+import numpy as np
+import h5py
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import datetime
+import platform
+import subprocess
+
+import absorptionCache as ac
+import fluxFit as ff
+import instrumentCache as ic
+import peakFinding as pf
+import panelRefinement as pr
+import stageTrace as st
+import vanadiumCorrections as vc
+
+#benchmark parameters (for fiddling)
+instruments = ['SNAP', 'TOPAZ']
+event_counts = [100000, 1000000]
+run_counts = [1, 4]
+
+data_directory = 'benchmarkData'
+
+#known crystal, sapphire
+lattice = {'a': 4.758, 'b': 4.758, 'c': 12.991, 'alpha': 90, 'beta': 90, 'gamma': 120}
+reflection_condition = 'Rhombohedrally centred, obverse'
+
+wavelength = [0.5, 3.5]
+peak_fraction = 0.5 #fraction of crystal run events in peaks, the rest is background
+
+#same calibration parameters as calibrate.py
+max_peaks = 1000
+density_threshold = 10000
+peak_radii = [0.1, 0.12, 0.15]
+sig_noise = 50
+
+#vanadium
+k_min, k_max = 1.8, 18
+flux_parameters = [2.0, 1.5, 0.01, 0.5, 1.2, 0.3]
+
+#traced algorithm calls (and stageTrace stages) summed into each reported
+#step of the pipelines
+calibration_steps = {'load': ['Load', 'LoadEventNexus', 'LoadIsawDetCal'],
+                     'ConvertToMD': ['ConvertToMD'],
+                     'FindPeaksMD': ['FindPeaksMD'],
+                     'IntegratePeaksMD': ['IntegratePeaksMD'],
+                     'SCDCalibratePanels': ['SCDCalibratePanels']}
+vanadium_steps = {'absorption': ['absorption'],
+                  'GroupDetectors': ['GroupDetectors'],
+                  'IntegrateFlux': ['IntegrateFlux']}
+
+instrument_settings = {
+    'SNAP': {'goniometer': {'Axis0': 'BL3:Mot:omega,0,1,0,1',
+                            'Axis1': 'BL3:Mot:phi,0.707,0.707,0,1'},
+             'angles': ['BL3:Mot:omega', 'BL3:Mot:phi'],
+             'state': {'det_arc1': -65.3, 'det_arc2': 104.95, 'det_lin1': 0.045, 'det_lin2': 0.043},
+             'monitorList': '-1,1179648',
+             'start_time': '2022-06-01T00:00:00'},
+    'TOPAZ': {'goniometer': {'Axis0': 'omega,0,1,0,1',
+                             'Axis1': 'phi,0,1,0,1'},
+              'angles': ['omega', 'phi'],
+              'state': {'chi': 135.0},
+              'monitorList': None,
+              'start_time': '2022-10-01T00:00:00'},
+}
+
+# h/m_n in m Angstrom/us, tof = L*lambda/h_m
+h_m = 3.956034e-3
+
+def buildInstrument(instrument, outputWorkspace):
+
+    settings = instrument_settings[instrument]
+    if instrument == 'SNAP':
+        ic.geometry(instrument, outputWorkspace, logs=settings['state'],
+                    monitorList=settings['monitorList'])
+    else:
+        ic.geometry(instrument, outputWorkspace)
+
+def detectorTable(instrument):
+
+    #detector ids, bank names, and flight paths of every detector pixel,
+    #cached in data_directory as building it loops over all detectors
+
+    cacheFile = os.path.join(data_directory, '{}_detectors.npz'.format(instrument))
+    if os.path.exists(cacheFile):
+        table = np.load(cacheFile)
+        return table['ids'], table['banks'], table['L']
+
+    buildInstrument(instrument, '__bench_inst')
+    ws = mtd['__bench_inst']
+    si = ws.spectrumInfo()
+
+    ids, banks, L = [], [], []
+    for i in range(ws.getNumberHistograms()):
+        if si.isMonitor(i):
+            continue
+        det = ws.getDetector(i)
+        bank = re.search(r'bank\d+', det.getFullName())
+        if bank is None:
+            continue
+        ids.append(det.getID())
+        banks.append(bank.group())
+        L.append(si.l1()+si.l2(i))
+    DeleteWorkspace(Workspace='__bench_inst')
+
+    ids, banks, L = np.array(ids), np.array(banks), np.array(L)
+    np.savez(cacheFile, ids=ids, banks=banks, L=L)
+    return ids, banks, L
+
+def lookup(ids, values):
+
+    #positions of values in the detector id array ids
+
+    order = np.argsort(ids)
+    return order[np.searchsorted(ids[order], values)]
+
+def writeEventNexus(filename, instrument, ids, tofs, logs, proton_charge=1e12):
+
+    #minimal event NeXus file that LoadEventNexus can read, one bank
+    #group per detector bank and a single pulse
+
+    allIds, banks, _ = detectorTable(instrument)
+    eventBanks = banks[lookup(allIds, ids)]
+
+    start_time = instrument_settings[instrument]['start_time']
+
+    with h5py.File(filename, 'w') as f:
+        entry = f.create_group('entry')
+        entry.attrs['NX_class'] = 'NXentry'
+        entry['start_time'] = start_time
+        entry['end_time'] = start_time
+        entry['proton_charge'] = proton_charge
+
+        inst = entry.create_group('instrument')
+        inst.attrs['NX_class'] = 'NXinstrument'
+        inst['name'] = instrument
+
+        for bank in np.unique(banks):
+            select = eventBanks == bank
+            group = entry.create_group('{}_events'.format(bank))
+            group.attrs['NX_class'] = 'NXevent_data'
+            group['event_id'] = ids[select].astype(np.uint32)
+            group['event_time_offset'] = tofs[select].astype(np.float32)
+            group['event_time_offset'].attrs['units'] = 'microsecond'
+            group['event_time_zero'] = np.array([0.0])
+            group['event_time_zero'].attrs['units'] = 'second'
+            group['event_time_zero'].attrs['offset'] = start_time
+            group['event_index'] = np.array([0], dtype=np.uint64)
+            group['total_counts'] = np.array([select.sum()], dtype=np.uint64)
+
+        daslogs = entry.create_group('DASlogs')
+        daslogs.attrs['NX_class'] = 'NXcollection'
+        for name, value in list(logs.items())+[('proton_charge', proton_charge)]:
+            log = daslogs.create_group(name)
+            log.attrs['NX_class'] = 'NXlog'
+            log['time'] = np.array([0.0])
+            log['time'].attrs['start'] = start_time
+            log['time'].attrs['units'] = 'second'
+            log['value'] = np.array([value], dtype=float)
+
+def makeCrystalRun(filename, instrument, nEvents, angles, seed):
+
+    #Bragg peaks of the benchmark crystal at goniometer angles plus a
+    #uniform background, peaks are found with PredictPeaks
+
+    rng = np.random.default_rng(seed)
+    settings = instrument_settings[instrument]
+    ids, banks, L = detectorTable(instrument)
+
+    logs = dict(settings['state'])
+    logs.update(dict(zip(settings['angles'], angles)))
+
+    buildInstrument(instrument, '__bench_inst')
+    for name, value in logs.items():
+        AddSampleLog(Workspace='__bench_inst', LogName=name, LogText=str(value), LogType='Number Series')
+    SetGoniometer(Workspace='__bench_inst', **settings['goniometer'])
+    SetUB(Workspace='__bench_inst', **lattice)
+    PredictPeaks(InputWorkspace='__bench_inst',
+                 WavelengthMin=wavelength[0],
+                 WavelengthMax=wavelength[1],
+                 MinDSpacing=0.5,
+                 MaxDSpacing=10,
+                 ReflectionCondition=reflection_condition,
+                 OutputWorkspace='__bench_peaks')
+
+    peaks = mtd['__bench_peaks']
+    peakIds = np.array([peaks.getPeak(j).getDetectorID() for j in range(peaks.getNumberPeaks())])
+    peakTofs = np.array([peaks.getPeak(j).getTOF() for j in range(peaks.getNumberPeaks())])
+    DeleteWorkspace(Workspace='__bench_peaks')
+    DeleteWorkspace(Workspace='__bench_inst')
+
+    nPeak = int(peak_fraction*nEvents) if len(peakIds) > 0 else 0
+    which = rng.integers(0, max(len(peakIds), 1), nPeak)
+    eventIds = peakIds[which]+rng.integers(-1, 2, nPeak) if nPeak > 0 else np.array([], dtype=int)
+    eventTofs = peakTofs[which]*(1+0.005*rng.standard_normal(nPeak)) if nPeak > 0 else np.array([])
+    valid = np.isin(eventIds, ids)
+    eventIds, eventTofs = eventIds[valid], eventTofs[valid]
+
+    nBkg = nEvents-len(eventIds)
+    bkgIds = ids[rng.integers(0, len(ids), nBkg)]
+    bkgTofs = L[lookup(ids, bkgIds)]*rng.uniform(wavelength[0], wavelength[1], nBkg)/h_m
+
+    writeEventNexus(filename, instrument,
+                    np.concatenate([eventIds, bkgIds]),
+                    np.concatenate([eventTofs, bkgTofs]),
+                    logs)
+
+def makeVanadiumRun(filename, instrument, nEvents, seed):
+
+    #incoherent scattering, uniform over pixels with momenta drawn from
+    #the flux model in fluxFit
+
+    rng = np.random.default_rng(seed)
+    ids, banks, L = detectorTable(instrument)
+
+    k = np.linspace(k_min, k_max, 2000)
+    cdf = np.cumsum(ff.flux(k, *flux_parameters))
+    cdf /= cdf[-1]
+    eventK = np.interp(rng.uniform(0, 1, nEvents), cdf, k)
+
+    pixel = rng.integers(0, len(ids), nEvents)
+    eventTofs = L[pixel]*(2*np.pi/eventK)/h_m
+
+    settings = instrument_settings[instrument]
+    logs = dict(settings['state'])
+    logs.update({name: 0.0 for name in settings['angles']})
+
+    writeEventNexus(filename, instrument, ids[pixel], eventTofs, logs)
+
+def detCalFile(instrument):
+
+    #DetCal of the synthetic instrument, as the state's Default.DetCal
+
+    os.makedirs(data_directory, exist_ok=True)
+    filename = os.path.join(data_directory, '{}.DetCal'.format(instrument))
+    if not os.path.exists(filename):
+        buildInstrument(instrument, '__bench_inst')
+        SaveIsawDetCal(InputWorkspace='__bench_inst', Filename=filename)
+        DeleteWorkspace(Workspace='__bench_inst')
+    return filename
+
+def dataFile(kind, instrument, nEvents, run):
+
+    #synthetic files are kept in data_directory and only generated once
+
+    os.makedirs(data_directory, exist_ok=True)
+    filename = os.path.join(data_directory, '{}_{}_{}_{}.nxs.h5'.format(instrument, kind, nEvents, run))
+    if not os.path.exists(filename):
+        if kind == 'crystal':
+            makeCrystalRun(filename, instrument, nEvents, [15.0*run, 0.0], seed=run)
+        else:
+            makeVanadiumRun(filename, instrument, nEvents, seed=run)
+    return filename
+
+results = []
+
+def report(entry):
+
+    results.append(entry)
+    print('{stage:>18} {pipeline} {instrument} events={events} runs={runs}: {wall:.2f} s'.format(**entry))
+
+def tracedSteps(mark, steps, **info):
+
+    #one result entry per step with the total time of its traced calls since
+    #st.events[mark]
+
+    for step, names in steps.items():
+        calls = [event for event in st.events[mark:] if event['ph'] == 'X' and event['name'] in names]
+        if len(calls) == 0:
+            continue
+        report(dict(stage=step,
+                    wall=sum(event['dur'] for event in calls)/1e6,
+                    cpu=sum(event['args']['cpu_s'] for event in calls),
+                    **info))
+
+class timed():
+
+    #records wall and cpu time of a block as one result entry
+
+    def __init__(self, stage, **info):
+        self.entry = dict(stage=stage, **info)
+
+    def __enter__(self):
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        self.entry['wall'] = time.perf_counter()-self.wall
+        self.entry['cpu'] = time.process_time()-self.cpu
+        report(self.entry)
+
+def benchmarkCalibration(instrument, nEvents, nRuns):
+
+    info = dict(pipeline='calibration', instrument=instrument, events=nEvents, runs=nRuns)
+    settings = instrument_settings[instrument]
+
+    filenames = [dataFile('crystal', instrument, nEvents, run) for run in range(nRuns)]
+    calibration_file = detCalFile(instrument)
+
+    pars = {'beamLineAxis0': settings['goniometer']['Axis0'],
+            'beamLineAxis1': settings['goniometer']['Axis1'],
+            'Q_max': 4*np.pi/wavelength[0],
+            'd_max': max(lattice['a'], lattice['b'], lattice['c']),
+            'max_peaks': max_peaks,
+            'density_threshold': density_threshold,
+            'peak_radii': peak_radii,
+            'sig_noise': sig_noise,
+            'wavelength': wavelength,
+            'chunk_banks': None,
+            'selective_loading': False,
+            'banks': None,
+            'grouping': None}
+
+    mark = len(st.events)
+
+    with timed('peak finding', **info):
+        pf.processRuns(filenames, calibration_file, pars, outputWorkspace='peaks')
+
+    FindUBUsingLatticeParameters(PeaksWorkspace='peaks', NumInitial=50, Iterations=10, **lattice)
+    IndexPeaks(PeaksWorkspace='peaks', Tolerance=0.05)
+    pf.filterPeaks('peaks',
+                   [('h^2+k^2+l^2','!=',0),
+                    ('QMod','>',0),
+                    ('BankName','!=','')],
+                   'peaks')
+
+    outdir = os.path.join(data_directory, 'calibration')
+    os.makedirs(outdir, exist_ok=True)
+
+    with timed('panel refinement', **info):
+        pr.refine('peaks', instrument,
+                  tuple(lattice[key] for key in ['a', 'b', 'c', 'alpha', 'beta', 'gamma']),
+                  outdir,
+                  {'L1': 0.2, 'TransBank': 0.5, 'RotBank': 5, 'SamplePos': 0.1})
+
+    tracedSteps(mark, calibration_steps, **info)
+
+    for ws in ['peaks', 'calibration_table']:
+        DeleteWorkspace(Workspace=ws)
+
+def benchmarkVanadium(instrument, nEvents, nRuns):
+
+    info = dict(pipeline='vanadium', instrument=instrument, events=nEvents, runs=nRuns)
+
+    filenames = [dataFile('vanadium', instrument, nEvents, run) for run in range(nRuns)]
+    rebin_param = '{},{},{}'.format(k_min, k_max, k_max)
+
+    with timed('load', **info):
+        Load(Filename='+'.join(filenames), OutputWorkspace='van')
+        SetSample(InputWorkspace='van',
+                  Geometry={'Shape': 'Sphere', 'Radius': 0.2,'Center': [0.,0.,0.]},
+                  Material={'ChemicalFormula': 'V', 'UnitCellVolume': 27.642, 'ZParameter': 2.})
+        NormaliseByCurrent(InputWorkspace='van', OutputWorkspace='van')
+        ConvertUnits(InputWorkspace='van', OutputWorkspace='van', Target='Momentum')
+        CropWorkspace(InputWorkspace='van', OutputWorkspace='van', XMin=k_min, XMax=k_max)
+        Rebin(InputWorkspace='van', OutputWorkspace='van', Params='{},{},{}'.format(k_min,(k_max-k_min)/500, k_max))
+
+    CreateGroupingWorkspace(InputWorkspace='van', GroupDetectorsBy='bank', OutputWorkspace='group')
+
+    mark = len(st.events)
+
+    with timed('corrections', **info):
+        vc.correct('van', 'group',
+                   {'Shape': 'Sphere', 'Radius': 0.2,'Center': [0.,0.,0.]},
+                   {'ChemicalFormula': 'V', 'UnitCellVolume': 27.642, 'ZParameter': 2.},
+                   rebin_param,
+                   cacheDir=os.path.join(data_directory, 'absorption_cache'))
+
+    spectra = {}
+    for ws in ['van_bank', 'van_flux']:
+        x, y, e = mtd[ws].extractX(), mtd[ws].extractY(), mtd[ws].extractE()
+        spectra[ws] = ((x[:,:-1]+x[:,1:])/2, y, e)
+
+    with timed('fitting', **info):
+        for k, y, e in spectra.values():
+            ff.fitSpectra(k, y, e)
+
+    with timed('flux', **info):
+        vc.integrateFlux('van_flux', 'flux', k_min, k_max)
+
+    tracedSteps(mark, vanadium_steps, **info)
+
+    for ws in ['sa', 'van_bank', 'van_flux', 'corr_bank', 'flux', 'group']:
+        DeleteWorkspace(Workspace=ws)
+
+def metadata():
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import mantid
+    return {'date': datetime.datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'mantid': mantid.__version__,
+            'commit': commit}
+
+def compare(oldFile, newFile):
+
+    #print the ratio of new to old wall time for every matching entry
+
+    def load(filename):
+        with open(filename, 'r') as f:
+            entries = json.load(f)['results']
+        key = lambda r: (r['pipeline'], r['instrument'], r['events'], r['runs'], r['stage'])
+        totals = {}
+        for r in entries:
+            totals[key(r)] = totals.get(key(r), 0)+r['wall']
+        return totals
+
+    old, new = load(oldFile), load(newFile)
+    for key in sorted(set(old) & set(new)):
+        print('{:>11} {:>6} {:>8} {:>2} {:>18}: {:8.2f} s -> {:8.2f} s ({:.2f}x)'.format(*key, old[key], new[key], new[key]/old[key]))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--compare':
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit()
+
+    outputFile = sys.argv[1] if len(sys.argv) > 1 else 'benchmark_results.json'
+
+    st.enable('{}_trace.json'.format(os.path.splitext(outputFile)[0]))
+    st.instrument(pf, pr, vc, ac)
+
+    for instrument in instruments:
+        for nEvents in event_counts:
+            for nRuns in run_counts:
+                benchmarkCalibration(instrument, nEvents, nRuns)
+                benchmarkVanadium(instrument, nEvents, nRuns)
+
+    with open(outputFile, 'w') as f:
+        json.dump({'metadata': metadata(), 'results': results}, f, indent=1)
@@ -0,0 +1,36 @@
+# helpers shared by the on-disk caches (peak stages, instrument geometry, ...)
+# cache entries are content addressed: the key is a hash of everything the
+# cached result depends on, so stale entries are simply never looked up again
+import os
+import json
+import hashlib
+
+_fileHashes = {}
+
+def fileHash(filename):
+
+    #sha1 of file contents, memoised on path and modification time
+
+    key = (filename,os.path.getmtime(filename))
+    if key not in _fileHashes:
+        sha = hashlib.sha1()
+        with open(filename,'rb') as f:
+            for block in iter(lambda: f.read(1<<20),b''):
+                sha.update(block)
+        _fileHashes[key] = sha.hexdigest()
+    return _fileHashes[key]
+
+def parsHash(*args):
+
+    #short hash of any json serialisable arguments
+
+    return hashlib.sha1(json.dumps(args,sort_keys=True).encode()).hexdigest()[:16]
+
+def saveCached(saveFunction,inputWorkspace,cacheFile):
+
+    #write to a temporary file and rename so an interrupted job never leaves
+    #a truncated file behind to be picked up later
+
+    tmpFile = f"{cacheFile}.{os.getpid()}.tmp.nxs"
+    saveFunction(InputWorkspace=inputWorkspace,Filename=tmpFile)
+    os.replace(tmpFile,cacheFile)
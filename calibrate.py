@@ -2,7 +2,13 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mantid.simpleapi import *
 import calibrationObject as calObj
+import peakFinding as pf
+import instrumentCache as ic
+import panelRefinement as pr
+import runMetadata as rm
+import stageTrace as st
 import sys
+import json
 
 crystalCalibrant = "sapphire"
 outputDetcalName = "test"
@@ -15,22 +21,93 @@ density_threshold = 10000
 peak_radii = [0.1, 0.12, 0.15]
 sig_noise = 50
 
+#number of worker processes for per-run peak finding (1 = serial)
+n_workers = 1
+
+#cache each run's found and integrated peaks in the state directory so reruns
+#only redo stages whose parameters changed (and crashed jobs resume), None to
+#disable. Entries are never removed, delete the directory to reclaim the space
+peak_cache = 'peakCache'
+
+#also cache each run's full md workspace, which saves the conversion when only
+#the peak finding parameters change but takes about as much space as the run
+cache_md = False
+
+#convert and find peaks this many banks at a time, with events restricted to
+#the wavelength band, so memory scales with the chunk not the run. None to
+#convert whole runs at once
+chunk_banks = None
+
+#load each bank only within the time of flight band of the wavelength range,
+#and once a calibration has indexed peaks only the banks that had them
+selective_loading = False
+
+#lite mode for quick passes: sum pixels into N x N super-pixels (e.g. '2x2'),
+#each placed at the average position of its pixels. None for full
+#resolution, e.g. a final incremental pass warm-started from a lite pass
+lite_grouping = None
+
+#write a Chrome trace (json) of the time and memory of every algorithm call,
+#None to disable
+trace_file = None
+
+#only find peaks for runs not already in the state's stored peak set, and
+#start the refinement from the state's last calibration.xml with the search
+#radii scaled by incremental_radius_scale
+incremental = False
+incremental_radius_scale = 0.2
+
+#panels are first refined on the refine_per_bank strongest peaks of each bank,
+#then on all peaks with shrinking search radii until no bank moves by more
+#than refine_tolerance (m, degrees) or refine_max_stages is reached
+refine_per_bank = 20
+refine_max_stages = 4
+refine_tolerance = (1e-4, 0.01)
 
 #############################################################
 # DON' EDIT BELOW
 #############################################################
 
+if trace_file is not None:
+    st.enable(trace_file)
+    st.instrument(globals(),calObj,pf,ic,pr)
+
 #beamline axes TODO: (Generalise...create a goniometer set-up file to store? This 
 #the goniometer could be automated via an input to calibrationObject 
 
 beamLineAxis0 ='BL3:Mot:omega,0,1,0,1'
 beamLineAxis1 ='BL3:Mot:phi,0.707,0.707,0,1'
 
-#create calibration object and use it to set parameters
-cal = calObj.create(runs[0],crystalCalibrant,verbose=True)
+#screen the run list from the state logs of the NeXus files (quick), runs
+#with matching logs then share one SNAPTools state lookup
+
+print(f"checking all {len(runs)} requested runs are from same state")
+runTable = rm.runTable(runs)
+stateSet = set([row["state"] for row in runTable])
+
+if len(stateSet) != 1 or None in stateSet:
+    print("WARNING state logs differ or are missing, checking with SNAPTools")
+    print(f"There are {len(stateSet)} log states in run list (None if the logs couldn't be read):")
+    for state in stateSet:
+        print(state, [row["run"] for row in runTable if row["state"] == state])
+
+#create calibration objects for all runs in one pass and use the first to set
+#parameters
+cals = calObj.create_many(runs,crystalCalibrant,verbose=True,grouping=lite_grouping,runTable=runTable)
+cal = cals[0]
+
+#the stateIDs resolved by SNAPTools are authoritative
+stateIDSet = set([tempCal.stateID if tempCal is not None else None for tempCal in cals])
+
+if len(stateIDSet) != 1 or None in stateIDSet:
+    print("ERROR all runs must be from same state!")
+    print(f"There are {len(stateIDSet)} stateIDs in run list (None if unresolved):")
+    for state in stateIDSet:
+        print(state, [run for run,tempCal in zip(runs,cals) if (tempCal.stateID if tempCal is not None else None) == state])
+    sys.exit()
 
 outdir = cal.calDir #output directory
-calibration_file = f"{cal.calDir}Default.DetCal"
+calibration_file = cal.calibrationFile
 
 a = cal.crystal.a
 b = cal.crystal.b
@@ -43,87 +120,66 @@ gamma = cal.crystal.gamma
 Q_max = 4*np.pi/wavelength[0]
 d_max = max([a,b,c])
 
-inst=cal.Inst #TODO: needed?
-
-#check that runs are all from the same state
-
-allID = []
-prog = 0
-for i,run in enumerate(runs):
-    prog = 100*((i+1)/len(runs))
-    print(f"checking all {len(runs)} requested runs are from same state: {prog:.1f}% complete", end = "\r")
-    tempCal = calObj.create(run,crystalCalibrant)
-    allID.append(tempCal.stateID)
-
-stateIDSet = set(allID)
-
-if len(stateIDSet) != 1:
-    print("ERROR all runs must be from same state!")
-    print(f"There are {len(stateIDSet)} states in run list:")
-    for state in stateIDSet:
-        print(state)
-    sys.exit()
-
-prog = 0
-print("Finding and integrating peaks")
-for i, run in enumerate(runs):
-
-    print(f"Working on run {run} ({(i+1)}/{len(runs)} runs)", end="\r")
-    cal = calObj.create(run,crystalCalibrant)
-
-    filename = cal.nxsFile
-
-    LoadEventNexus(Filename=filename,
-                   OutputWorkspace='data')
-
-    LoadIsawDetCal(InputWorkspace='data',
-                   Filename=calibration_file)
-
-    SetGoniometer(Workspace='data',
-                  Axis0=beamLineAxis0,
-                  Axis1=beamLineAxis1,
-                #   Axis2=beamLineAxis0, #TODO automatically accommodate 1,2 or 3 axes
-                  Average=True)
-
-    ConvertToMD(InputWorkspace='data',
-                QDimensions='Q3D',
-                dEAnalysisMode='Elastic',
-                Q3DFrames='Q_sample',
-                MinValues=[-Q_max,-Q_max,-Q_max],
-                MaxValues=[+Q_max,+Q_max,+Q_max],
-                OutputWorkspace='md')
-
-    FindPeaksMD(InputWorkspace='md',
-                PeakDistanceThreshold=2*np.pi/d_max,
-                MaxPeaks=max_peaks,
-                DensityThresholdFactor=density_threshold,
-                OutputWorkspace='peaks_ws')
-
-    IntegratePeaksMD(InputWorkspace='md',
-                     PeakRadius=peak_radii[0],
-                     BackgroundInnerRadius=peak_radii[1],
-                     BackgroundOuterRadius=peak_radii[2],
-                     PeaksWorkspace='peaks_ws',
-                     OutputWorkspace='peaks_ws',
-                     Ellipsoid=True,
-                     FixQAxis=True,
-                     FixMajorAxisLength=False,
-                     UseCentroid=True,
-                     MaxIterations=3)
-
-    FilterPeaks(InputWorkspace='peaks_ws', 
-                FilterVariable='Signal/Noise', 
-                FilterValue=sig_noise, 
-                Operator='>',
-                OutputWorkspace='peaks_ws')
-
-    if i == 0:
-        CloneWorkspace(InputWorkspace='peaks_ws',
-                       OutputWorkspace='peaks')
-    else:
-        CombinePeaksWorkspaces(LHSWorkspace='peaks_ws', 
-                               RHSWorkspace='peaks', 
-                               OutputWorkspace='peaks')
+inst=cal.Inst
+
+pars = {"beamLineAxis0":beamLineAxis0,
+        "beamLineAxis1":beamLineAxis1,
+        "Q_max":Q_max,
+        "d_max":d_max,
+        "max_peaks":max_peaks,
+        "density_threshold":density_threshold,
+        "peak_radii":peak_radii,
+        "sig_noise":sig_noise,
+        "wavelength":wavelength,
+        "chunk_banks":chunk_banks,
+        "selective_loading":selective_loading,
+        "banks":None,
+        "grouping":lite_grouping,
+        "cache_md":cache_md}
+
+#banks with indexed peaks in the last pass on this state
+peakBanksFile = os.path.join(outdir,'peakBanks.json')
+if selective_loading and os.path.exists(peakBanksFile):
+    with open(peakBanksFile,'r') as f:
+        pars["banks"] = json.load(f)
+
+filenames = [tempCal.nxsFile for tempCal in cals]
+cacheDir = os.path.join(outdir,peak_cache) if peak_cache is not None else None
+
+peakSetFile = os.path.join(outdir,'peaks.nxs')
+peakSetKey = pf.peakSetKey(calibration_file,pars)
+calibrationXml = os.path.join(outdir,'calibration.xml')
+
+storedRuns = []
+if incremental:
+    storedRuns = pf.loadPeakSet(peakSetFile,peakSetKey,'stored_peaks')
+    if storedRuns is None:
+        storedRuns = []
+        print("No stored peaks to add to, processing all runs")
+
+newFiles = [filename for filename in filenames if os.path.basename(filename) not in storedRuns]
+
+print(f"Finding and integrating peaks for {len(newFiles)} new runs")
+if len(newFiles) != 0:
+    with st.stage('peak finding'):
+        if n_workers > 1:
+            pf.processRunsParallel(newFiles,calibration_file,pars,n_workers,outputWorkspace='peaks',cacheDir=cacheDir)
+        else:
+            pf.processRuns(newFiles,calibration_file,pars,outputWorkspace='peaks',cacheDir=cacheDir)
+
+if len(storedRuns) != 0:
+    pf.mergePeaks(['stored_peaks','peaks'] if len(newFiles) != 0 else ['stored_peaks'],'peaks')
+    DeleteWorkspace(Workspace='stored_peaks')
+
+pf.savePeakSet('peaks',peakSetFile,peakSetKey,storedRuns+[os.path.basename(filename) for filename in newFiles])
+
+#warm start from the previous calibration of this state
+radius_scale = 1
+if incremental and os.path.exists(calibrationXml):
+    ic.geometry(inst,'inst',calibrationFiles=[calibrationXml],keep=False)
+    ic.applyToPeaks('inst','peaks',['peaks'])
+    DeleteWorkspace(Workspace='inst')
+    radius_scale = incremental_radius_scale
 
 FindUBUsingLatticeParameters(PeaksWorkspace='peaks',
                              a=a,
@@ -137,81 +193,35 @@ FindUBUsingLatticeParameters(PeaksWorkspace='peaks',
 
 IndexPeaks(PeaksWorkspace='peaks', Tolerance=0.05)
 
-FilterPeaks(InputWorkspace='peaks', 
-            FilterVariable='h^2+k^2+l^2', 
-            FilterValue=0, 
-            Operator='!=',
-            OutputWorkspace='peaks')
-
-FilterPeaks(InputWorkspace='peaks', 
-            FilterVariable='QMod', 
-            FilterValue=0, 
-            Operator='>',
-            OutputWorkspace='peaks')
-
-FilterPeaks(InputWorkspace='peaks',
-            BankName='',
-            Criterion='!=',
-            OutputWorkspace='peaks')
-
-SCDCalibratePanels(PeakWorkspace='peaks',
-                   RecalculateUB=True,
-                   a=a,
-                   b=b,
-                   c=c,
-                   alpha=alpha,
-                   beta=beta,
-                   gamma=gamma,
-                   OutputWorkspace='calibration_table',
-                   DetCalFilename=os.path.join(outdir, 'calibration.DetCal'),
-                   CSVFilename=os.path.join(outdir, 'calibration.csv'),
-                   XmlFilename=os.path.join(outdir, 'calibration.xml'),
-                   CalibrateT0=False,
-                   SearchRadiusT0=10,
-                   CalibrateL1=True,
-                   SearchRadiusL1=0.2,
-                   CalibrateBanks=True,
-                   SearchRadiusTransBank=0.5,
-                   SearchRadiusRotXBank=5,
-                   SearchRadiusRotYBank=5,
-                   SearchRadiusRotZBank=5,
-                   VerboseOutput=True,
-                   SearchRadiusSamplePos=0.1,
-                   TuneSamplePosition=True,
-                   CalibrateSize=False,
-                   SearchRadiusSize=0.1,
-                   FixAspectRatio=True)
-
-CloneWorkspace(InputWorkspace='peaks',
-               OutputWorkspace='calibration_ws')
-
-LoadEmptyInstrument(InstrumentName='inst',
-                    OutputWorkspace='inst')
-
-LoadParameterFile(Workspace='inst', 
-                  Filename=os.path.join(outdir, 'calibration.xml'))
+pf.filterPeaks('peaks',
+               [('h^2+k^2+l^2','!=',0),
+                ('QMod','>',0),
+                ('BankName','!=','')],
+               'peaks')
 
-sample_pos = mtd['inst'].getInstrument().getComponentByName('sample-position').getPos()
+with open(peakBanksFile,'w') as f:
+    json.dump(sorted(set(mtd['peaks'].column('BankName'))),f)
 
-for bank in np.unique(mtd['calibration_ws'].column(13)):
-    MoveInstrumentComponent(Workspace='inst', 
-                            ComponentName=bank, 
-                            X=-sample_pos[0], Y=-sample_pos[1], Z=-sample_pos[2], 
-                            RelativePosition=True)
+with st.stage('panel refinement'):
+    pr.refine('peaks',inst,(a,b,c,alpha,beta,gamma),outdir,
+              {"L1":0.2*radius_scale,
+               "TransBank":0.5*radius_scale,
+               "RotBank":5*radius_scale,
+               "SamplePos":0.1*radius_scale},
+              perBank=refine_per_bank,
+              maxStages=refine_max_stages,
+              tolerance=refine_tolerance)
 
-MoveInstrumentComponent(Workspace='inst', 
-                        ComponentName='sample-position', 
-                        X=-sample_pos[0], Y=-sample_pos[1], Z=-sample_pos[2], 
-                        RelativePosition=True)
+#peaks with the refined geometry recentred on the sample position, the
+#recentred instrument is built once and applied to both copies
 
-MoveInstrumentComponent(Workspace='inst', 
-                        ComponentName='moderator', 
-                        X=0, Y=0, Z=-sample_pos[2], 
-                        RelativePosition=True)
+ic.geometry(inst, 'inst',
+            calibrationFiles=[os.path.join(outdir, 'calibration.xml')],
+            recentre=True,
+            keep=False)
 
-ApplyInstrumentToPeaks(InputWorkspace='calibration_ws', 
-                       InstrumentWorkspace='inst',
-                       OutputWorkspace='calibration_ws')
+ic.applyToPeaks('inst', 'peaks', ['calibration_ws', 'detcal_ws'])
+DeleteWorkspace(Workspace='inst')
 
 SCDCalibratePanels(PeakWorkspace='calibration_ws',
                    RecalculateUB=False,
@@ -243,49 +253,11 @@ SCDCalibratePanels(PeakWorkspace='calibration_ws',
 
 # ---
 
-CloneWorkspace(InputWorkspace='peaks',
-               OutputWorkspace='detcal_ws')
-
-LoadEmptyInstrument(InstrumentName='inst',
-                    OutputWorkspace='inst')
-
-LoadParameterFile(Workspace='inst', 
-                  Filename=os.path.join(outdir, 'calibration.xml'))
-
-sample_pos = mtd['inst'].getInstrument().getComponentByName('sample-position').getPos()
-
-for bank in np.unique(mtd['detcal_ws'].column(13)):
-    MoveInstrumentComponent(Workspace='inst', 
-                            ComponentName=bank, 
-                            X=-sample_pos[0], Y=-sample_pos[1], Z=-sample_pos[2], 
-                            RelativePosition=True)
-
-MoveInstrumentComponent(Workspace='inst', 
-                        ComponentName='sample-position', 
-                        X=-sample_pos[0], Y=-sample_pos[1], Z=-sample_pos[2], 
-                        RelativePosition=True)
-
-MoveInstrumentComponent(Workspace='inst', 
-                        ComponentName='moderator', 
-                        X=0, Y=0, Z=-sample_pos[2], 
-                        RelativePosition=True)
-
-ApplyInstrumentToPeaks(InputWorkspace='detcal_ws', 
-                       InstrumentWorkspace='inst',
-                       OutputWorkspace='detcal_ws')
-
-# ---
-
-CloneWorkspace(InputWorkspace='peaks',
-               OutputWorkspace='cal')
-
-LoadEmptyInstrument(InstrumentName='inst',
-                    OutputWorkspace='inst')
+ic.geometry(inst, 'inst',
+            calibrationFiles=[os.path.join(outdir, 'cal.xml')],
+            keep=False)
 
-LoadParameterFile(Workspace='inst', 
-                  Filename=os.path.join(outdir, 'cal.xml'))
+ic.applyToPeaks('inst', 'peaks', ['cal'])
+DeleteWorkspace(Workspace='inst')
 
-ApplyInstrumentToPeaks(InputWorkspace='cal', 
-                       InstrumentWorkspace='inst',
-                       OutputWorkspace='cal')
-                      
\ No newline at end of file
+st.write()
@@ -1,5 +1,7 @@
 # class to hold the details of SNAP calibration
-from mantid.simpleapi import *
+# mantid, SNAPTools and crystalBox are slow to import so they are only
+# imported once geometry, instrument or calibrant work is needed, which keeps
+# importing this module (e.g. for runMetadata's state index lookups) fast
 import os
 
 #add this folder to the path
@@ -8,91 +10,268 @@ sys.path.append("/SNS/SNAP/shared/Malcolm/code/SNAPRedScripted/")
 sys.path.append("/SNS/SNAP/shared/Malcolm/code/crystalBox/")
 
 import json
+import copy
+import fcntl
+import contextlib
 
-#import SNAPTools some useful functions for snap data
-import SNAPTools as snp
+sxlCalibHome = '/SNS/SNAP/shared/Calibration/SingleCrystal/'
+calibrantLibrary = f"{sxlCalibHome}/CalibrantSamples/"
+stateIndexFile = f"{sxlCalibHome}runStateIndex.json"
 
+#instrument parameters don't change between runs so only load them once
+_instDict = None
+#calibrant crystals by material name
+_calibrants = {}
 
-#needed while hacking
-import importlib
-importlib.reload(snp)
+def snapTools():
 
-sxlCalibHome = '/SNS/SNAP/shared/Calibration/SingleCrystal/'
-calibrantLibrary = f"{sxlCalibHome}/CalibrantSamples/"
+    #SNAPTools some useful functions for snap data (imports mantid)
+    import SNAPTools as snp
+    return snp
+
+def instPrm():
+
+    global _instDict
+    if _instDict is None:
+        _instDict = snapTools().loadSNAPInstPrm()
+    return _instDict
+
+def calibrant(calibrantMaterial):
+
+    #crystalBox.Box for calibrantMaterial, built once per material
+
+    if calibrantMaterial not in _calibrants:
+        import crystalBox as crys
+        _calibrants[calibrantMaterial] = crys.Box(calibrantMaterial)
+    return _calibrants[calibrantMaterial]
+
+def loadStateIndex():
+
+    #on-disk index of run -> stateID/stateDict, see resolveState
+
+    if not os.path.exists(stateIndexFile):
+        return {}
+    try:
+        with open(stateIndexFile,'r') as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        print(f"WARNING couldn't read state index:{stateIndexFile}, rebuilding")
+        return {}
+
+def saveStateIndex(stateIndex):
+
+    #numpy scalars and arrays in stateDict aren't json serialisable
+    def toJson(obj):
+        if hasattr(obj,'tolist'):
+            return obj.tolist()
+        return str(obj)
+
+    tmpFile = f"{stateIndexFile}.{os.getpid()}.tmp"
+    try:
+        with open(tmpFile,'w') as f:
+            json.dump(stateIndex,f,indent=1,default=toJson)
+        os.replace(tmpFile,stateIndexFile)
+    except (OSError,TypeError,ValueError):
+        print(f"WARNING couldn't write state index:{stateIndexFile}")
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+def resolveState(runNumber,stateIndex):
+
+    #returns stateID,stateDict for runNumber, using stateIndex if the entry is
+    #still valid (i.e. the NeXus file hasn't changed since it was indexed).
+    #stateIndex is updated in place, returns None,None if state can't be found
+
+    key = str(runNumber)
+    entry = stateIndex.get(key)
+    if entry is not None:
+        nxsFile = entry["stateDict"]["nxsFile"]
+        if os.path.exists(nxsFile) and os.path.getmtime(nxsFile) == entry["mtime"]:
+            return entry["stateID"],entry["stateDict"]
+
+    stateID,stateDict,errorState = snapTools().StateFromRunFunction(runNumber)
+    if errorState['value'] != 0: #something went wrong
+        print(f"Error in {errorState['function']}")
+        return None,None
+
+    stateIndex[key] = {"stateID":stateID,
+                       "stateDict":stateDict,
+                       "mtime":os.path.getmtime(stateDict["nxsFile"])}
+    return stateID,stateDict
+
+@contextlib.contextmanager
+def stateLock(calDir):
+
+    #exclusive lock on a state directory, held while its files are created so
+    #workers started together on the same state don't all build them
+
+    with open(f"{calDir}.lock",'w') as lockFile:
+        fcntl.flock(lockFile,fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile,fcntl.LOCK_UN)
+
+def create_many(runs,calibrantMaterial,verbose=False,grouping=None,runTable=None):
+
+    #resolve a whole run list in one pass. Runs from the same state share
+    #their state initialisation and calibrant crystal, only the run specific
+    #attributes differ. Returns a list of create objects in the order of runs,
+    #runs whose state couldn't be resolved are None.
+    #With a runTable (see runMetadata.runTable) only the first run of each
+    #screened state, and runs whose logs couldn't be read, are resolved by
+    #SNAPTools (or the index), the others take its state and their own nxsFile
+
+    stateIndex = loadStateIndex()
+    nIndexed = len(stateIndex)
+
+    rows = {} if runTable is None else {row["run"]:row for row in runTable}
+
+    cals = []
+    byState = {}
+    byKey = {}
+    for run in runs:
+        row = rows.get(run,{"state":None,"nxsFile":None})
+        if row["state"] in byKey and row["nxsFile"] is not None:
+            stateID,stateDict = byKey[row["state"]]
+            stateDict = dict(stateDict,nxsFile=row["nxsFile"])
+        else:
+            stateID,stateDict = resolveState(run,stateIndex)
+            if row["state"] is not None and stateID is not None:
+                byKey[row["state"]] = stateID,stateDict
+        if stateID is None:
+            cals.append(None)
+            continue
+        if stateID not in byState:
+            byState[stateID] = create(run,calibrantMaterial,verbose=verbose,
+                                      stateIndex=stateIndex,
+                                      grouping=grouping)
+            cals.append(byState[stateID])
+        else:
+            cals.append(byState[stateID].forRun(run,stateDict))
+
+    if len(stateIndex) != nIndexed:
+        saveStateIndex(stateIndex)
+
+    return cals
 
 class create():
     
     
-    def __init__(self,runNumber,calibrantMaterial,verbose=False):
+    def __init__(self,runNumber,calibrantMaterial,verbose=False,stateIndex=None,grouping=None):
 
-        self.verbose = verbose
+        #grouping (e.g. '2x2') selects lite mode, where pixels are summed into
+        #super-pixels. calibrationFile is the state's DetCal in both modes,
+        #GroupDetectors places each super-pixel at the average position of its
+        #pixels
 
-        self.isLite = False #not using lite mode for now.
-        instDict = snp.loadSNAPInstPrm()
+        self.verbose = verbose
 
-        self.Inst = instDict["name"]
+        self.grouping = grouping
+        self.isLite = grouping is not None
         self.calDirectory=sxlCalibHome
 
-        self.stateID,self.stateDict,errorState= snp.StateFromRunFunction(runNumber)
-        if errorState['value'] != 0: #something went wrong
-            print(f"Error in {errorState['function']}")
+        #stateIndex is supplied by create_many, which saves it at the end
+        saveIndex = stateIndex is None
+        if saveIndex:
+            stateIndex = loadStateIndex()
+            nIndexed = len(stateIndex)
+
+        self.runNumber = runNumber
+        self.stateID,self.stateDict = resolveState(runNumber,stateIndex)
+        if self.stateID is None:
             return
 
+        if saveIndex and len(stateIndex) != nIndexed:
+            saveStateIndex(stateIndex)
+
         self.nxsFile = self.stateDict["nxsFile"]
         #buildPath to output folder
         self.outdir = sxlCalibHome + self.stateID + '/' #don't like this name to making an alias
         self.calDir = sxlCalibHome + self.stateID + '/'
 
+        self.Inst = instPrm()["name"]
+
         #check state already exists and initialise if necessary
         self.initState()
+        self.calibrationFile = self.detCalPath
 
         #set up calibrant if specified
         if calibrantMaterial != None:
             self.setCalibrant(calibrantMaterial)
+
+    def forRun(self,runNumber,stateDict):
+
+        #cheap copy of this object for another run from the same state,
+        #shares the calibrant crystal and skips state initialisation
+        other = copy.copy(self)
+        other.runNumber = runNumber
+        other.stateDict = stateDict
+        other.nxsFile = stateDict["nxsFile"]
+        return other
         
     def initState(self):
 
     #     #checks if state exists and that it contains a default DetCal file
     #     #if neither exists, they'll be created
 
+        self.detCalPath = f"{self.calDir}Default.DetCal"
+
+        #Default.DetCal only appears (by rename) once complete, so if it's
+        #there the state is ready
+        if os.path.exists(self.detCalPath):
+            if self.verbose:
+                print(f"State available")
+            return
+
         if not os.path.exists(self.calDir):
             # attempt to make directory
             try:
-                os.makedirs(self.calDir)
+                os.makedirs(self.calDir,exist_ok=True)
                 print(f"Created new state directory:{self.calDir}")
             except:
                 print(f"ERROR couldn/'t initialise directory:{self.calDir}")
                 print("Check write priviledges")
                 return
 
-        self.detCalPath = f"{self.calDir}Default.DetCal"
-
-        if not os.path.exists(self.detCalPath):
-            self.makeDetCal()
-            print(f"Initialised state")
-            return
-        else:
-            if self.verbose:
-                print(f"State available")
+        #first process in builds the DetCal, others wait for it then reuse it.
+        #The lock file (and geometry cache) live in the state directory, so
+        #this fails if it can't be written to
+        try:
+            with stateLock(self.calDir):
+                if os.path.exists(self.detCalPath):
+                    if self.verbose:
+                        print(f"State initialised by another process")
+                    return
+                self.makeDetCal()
+                print(f"Initialised state")
+        except OSError:
+            print(f"ERROR couldn/'t initialise directory:{self.calDir}")
+            print("Check write priviledges")
         return
 
     def setCalibrant(self,calibrantMaterial): 
 
     # get and set crystal parameters 
-        import crystalBox as crys
 
         if self.verbose:
             print(f"setting crystal info for: {calibrantMaterial}")
-        self.crystal = crys.Box(calibrantMaterial)
+        self.crystal = calibrant(calibrantMaterial)
         return
 
     def makeDetCal(self):
 
+        import mantid.simpleapi as simpleapi
+        import instrumentCache as ic
+        import stageTrace as st
+
+        #mantid is only imported here, so st.instrument(calObj) can't see
+        #these algorithms in the module namespace, wrap them explicitly
+        SaveIsawDetCal = st.traced('SaveIsawDetCal',simpleapi.SaveIsawDetCal)
+        DeleteWorkspace = st.traced('DeleteWorkspace',simpleapi.DeleteWorkspace)
+
         print("generating instrument geometry")
         #create a DetCal file and write to calDir
-        SNAP = LoadEmptyInstrument(InstrumentName="SNAP")
-        
-
         pars = {
         "det_arc1":str(self.stateDict["det_arc1"]),
         "det_lin1":str(self.stateDict["det_lin1"]),    
@@ -100,19 +279,19 @@ class create():
         "det_lin2":str(self.stateDict["det_lin2"])
         }
 
-        for key in pars:
-            AddSampleLog(Workspace="SNAP",
-            LogName=key,LogText=pars[key],
-            LogType='Number Series')
-            
-        LoadInstrument(Workspace="SNAP",MonitorList='-1,1179648', RewriteSpectraMap='False',InstrumentName='SNAP')
-        
+        ic.geometry("SNAP","SNAP",logs=pars,monitorList='-1,1179648',keep=False)
+
+        #write to a temporary file and rename so a partial DetCal is never seen
+        tmpPath = f"{self.calDir}.Default.{os.getpid()}.DetCal"
         try:
             SaveIsawDetCal(InputWorkspace="SNAP",
-                    Filename=self.detCalPath)
+                    Filename=tmpPath)
+            os.replace(tmpPath,self.detCalPath)
         except:
             print(f"Error: couldn/'t create DetCal at :{self.detCalPath}")
             print("Do you have write priviledges there?")
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
         
         DeleteWorkspace(Workspace="SNAP")
 
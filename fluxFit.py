@@ -0,0 +1,99 @@
+# batch fitting of the vanadium flux model used by vanadium.py
+# all spectra are fitted in one call with an analytic jacobian, each spectrum
+# starting from its neighbour's solution, and for large numbers of spectra
+# blocks of neighbouring spectra can be shared out over a small process pool
+import numpy as np
+import scipy.optimize
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+#order of the parameters in the rows returned by fitSpectra
+parameterNames = ['phi_0', 'lambda_0', 'C_epi', 'C_fast', 'alpha', 'beta']
+
+default_x0 = [0, 0, 0, 0, 0, 0]
+
+# the pool is forked from a process that has usually started mantid's
+# threads, so it's kept small and only used when each worker gets enough
+# spectra to be worth it
+max_workers = 4
+min_spectra_per_worker = 50
+
+def flux(k, phi_0, lambda_0, C_epi, C_fast, alpha, beta):
+    therm = phi_0*(4*np.pi**2)/k**2*np.exp(-(4*np.pi**2)/(k**2*lambda_0**2))
+    epi = C_epi*k**3/(2*np.pi)**3
+    fast = C_fast*(2*np.pi)**alpha/k**alpha*np.exp(-(2*np.pi*beta)/k)
+    return therm+epi+fast
+
+def flux_jacobian(k, phi_0, lambda_0, C_epi, C_fast, alpha, beta):
+
+    # derivatives of flux with respect to each parameter, shape (len(k), 6)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        a = (4*np.pi**2)/k**2
+        g = np.exp(-a/lambda_0**2)
+        # g vanishes faster than 1/lambda_0**3 diverges as lambda_0 -> 0
+        d_lambda_0 = np.where(g > 0, phi_0*a*g*2*a/lambda_0**3, 0)
+        h = (2*np.pi/k)**alpha*np.exp(-(2*np.pi*beta)/k)
+        fast = C_fast*h
+
+        return np.column_stack([a*g,
+                                d_lambda_0,
+                                k**3/(2*np.pi)**3,
+                                h,
+                                fast*np.log(2*np.pi/k),
+                                -fast*2*np.pi/k])
+
+def residuals(params, k, y, e):
+    return (flux(k, *params)-y)/e
+
+def residuals_jacobian(params, k, y, e):
+    return flux_jacobian(k, *params)/e[:,None]
+
+def fit(k, y, e, x0=default_x0):
+
+    return scipy.optimize.least_squares(residuals,
+                                        x0=x0,
+                                        jac=residuals_jacobian,
+                                        args=(k, y, e),
+                                        loss='soft_l1')
+
+def fitBlock(k, y, e):
+
+    # fit neighbouring spectra in turn, warm starting each from the previous
+    # solution and falling back to the default start if that doesn't converge
+
+    params = np.zeros((k.shape[0], len(default_x0)))
+    x0 = default_x0
+    for i in range(k.shape[0]):
+        sol = fit(k[i], y[i], e[i], x0)
+        if not sol.success and x0 is not default_x0:
+            sol = fit(k[i], y[i], e[i])
+        params[i] = sol.x
+        x0 = sol.x if sol.success else default_x0
+    return params
+
+def fitSpectra(k, y, e, nWorkers=1):
+
+    # fit the flux model to every spectrum (row) of k, y, e
+    # returns an array of shape (number of spectra, 6), see parameterNames
+    # nWorkers > 1 allows a pool of up to max_workers processes, None as many
+    # as there are cores (within the same limits)
+
+    k, y, e = np.atleast_2d(k), np.atleast_2d(y), np.atleast_2d(e)
+    n = k.shape[0]
+
+    if nWorkers is None:
+        nWorkers = os.cpu_count()
+    nWorkers = max(1, min(nWorkers, max_workers, n//min_spectra_per_worker))
+
+    if nWorkers == 1:
+        return fitBlock(k, y, e)
+
+    # fork so the workers don't re-run the calling script
+    blocks = np.array_split(np.arange(n), nWorkers)
+    with ProcessPoolExecutor(max_workers=nWorkers,
+                             mp_context=multiprocessing.get_context('fork')) as pool:
+        results = pool.map(fitBlock, *zip(*[(k[b], y[b], e[b]) for b in blocks]))
+        return np.concatenate(list(results))
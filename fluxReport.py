@@ -0,0 +1,74 @@
+# deferred diagnostic plots for the vanadium flux fits
+# vanadium.py only records the fit arrays, the figures are rendered afterwards
+# in a background thread into one multi-page pdf or a set of pngs. The
+# object-oriented matplotlib api is used (no pyplot) so nothing needs a display
+# and the thread doesn't touch any global figure state
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_pdf import PdfPages
+
+import os
+import threading
+
+def drawSpectrum(fig, k, y, e, fit, k_corr, y_corr, e_corr, fit_corr, y_abs):
+
+    ax = fig.subplots(2, 2, sharex='col', sharey='row')
+
+    ax[0,0].errorbar(k, y/y.max(), e/y.max(), fmt='.', label='orig')
+    ax[0,0].plot(k, fit/y.max(), '-', label='orig')
+    ax[0,1].errorbar(2*np.pi/k, y/y.max(), e/y.max(), fmt='.', label='orig')
+    ax[0,1].plot(2*np.pi/k, fit/y.max(), '-', label='orig')
+
+    ax[0,0].errorbar(k_corr, y_corr/y_corr.max(), e_corr/y_corr.max(), fmt='.', label='corr')
+    ax[0,0].plot(k_corr, fit_corr/y_corr.max(), '-', label='corr')
+    ax[0,1].errorbar(2*np.pi/k_corr, y_corr/y_corr.max(), e_corr/y_corr.max(), fmt='.', label='corr')
+    ax[0,1].plot(2*np.pi/k_corr, fit_corr/y_corr.max(), '-', label='corr')
+
+    ax[1,0].plot(k_corr, 1/y_abs*y_abs.max(), '-', label='abs')
+    ax[1,1].plot(2*np.pi/k_corr, 1/y_abs*y_abs.max(), '-', label='abs')
+
+    ax[1,0].legend()
+    ax[1,1].legend()
+
+    ax[1,0].set_xlabel(r'$k$ [$\AA^{-1}$]')
+    ax[1,1].set_xlabel(r'$\lambda$ [$\AA$]')
+    ax[0,0].axvline(2*np.pi/0.75, color='k', linestyle='--')
+    ax[1,0].axvline(2*np.pi/0.75, color='k', linestyle='--')
+    ax[0,1].axvline(0.75, color='k', linestyle='--')
+    ax[1,1].axvline(0.75, color='k', linestyle='--')
+    ax[0,0].legend()
+    ax[0,1].legend()
+
+def render(filename, fmt, arrays):
+
+    # arrays holds 2d (spectrum, bin) arrays with the keywords of drawSpectrum
+    # fmt 'pdf' writes filename as one page per spectrum, 'png' writes
+    # filename_0000.png, filename_0001.png, ... one per spectrum
+
+    n = arrays['k'].shape[0]
+
+    if fmt == 'pdf':
+        with PdfPages(filename) as pdf:
+            for i in range(n):
+                fig = Figure()
+                drawSpectrum(fig, **{key: val[i] for key, val in arrays.items()})
+                fig.suptitle('spectrum {}'.format(i))
+                pdf.savefig(fig)
+    elif fmt == 'png':
+        base = os.path.splitext(filename)[0]
+        for i in range(n):
+            fig = Figure()
+            drawSpectrum(fig, **{key: val[i] for key, val in arrays.items()})
+            fig.suptitle('spectrum {}'.format(i))
+            fig.savefig('{}_{:04d}.png'.format(base, i))
+    else:
+        raise ValueError('unknown report format {}'.format(fmt))
+
+def start(filename, fmt, **arrays):
+
+    # render the report in a background thread, join the returned thread
+    # before exiting to make sure the report is complete
+
+    thread = threading.Thread(target=render, args=(filename, fmt, arrays))
+    thread.start()
+    return thread
@@ -0,0 +1,216 @@
+# cache of ready-built instrument geometry
+# building an instrument (LoadEmptyInstrument, state logs, LoadInstrument,
+# calibration files) is repeated many times across calibrate.py,
+# calibrationObject.py and vanadium.py. The built workspace is kept hidden in
+# the ADS, so it survives between script runs in the same Mantid session, and
+# callers get a clone of it. If cacheDir is given it is also saved to disk for
+# use by later sessions. The N x N super-pixel groupings used by lite
+# (grouped) passes are kept the same way.
+from mantid.simpleapi import *
+import numpy as np
+
+import os
+
+from cacheTools import fileHash, parsHash, saveCached
+
+def applyCalibration(workspace,calibrationFile):
+
+    #apply a detector (.DetCal or .xml parameter file) or tube (.nxs table)
+    #calibration to workspace
+
+    ext = os.path.splitext(calibrationFile)[1]
+    if ext == '.xml':
+        LoadParameterFile(Workspace=workspace,
+                          Filename=calibrationFile)
+    elif ext == '.nxs':
+        LoadNexus(Filename=calibrationFile,
+                  OutputWorkspace='__tube_table')
+        ApplyCalibration(Workspace=workspace, CalibrationTable='__tube_table')
+        DeleteWorkspace(Workspace='__tube_table')
+    else:
+        LoadIsawDetCal(InputWorkspace=workspace,
+                       Filename=calibrationFile)
+
+def recentreSample(workspace):
+
+    #shift the instrument so the (refined) sample position is at the origin.
+    #All components move together in a single rigid translation of the
+    #instrument, the moderator is then put back on the beam axis so it only
+    #moves along the beam
+
+    instrument = mtd[workspace].getInstrument()
+    sample_pos = instrument.getComponentByName('sample-position').getPos()
+
+    MoveInstrumentComponent(Workspace=workspace,
+                            ComponentName=instrument.getName(),
+                            X=-sample_pos[0], Y=-sample_pos[1], Z=-sample_pos[2],
+                            RelativePosition=True)
+
+    MoveInstrumentComponent(Workspace=workspace,
+                            ComponentName='moderator',
+                            X=sample_pos[0], Y=sample_pos[1], Z=0,
+                            RelativePosition=True)
+
+def applyToPeaks(instrumentWorkspace,inputWorkspace,outputWorkspaces):
+
+    #copy inputWorkspace into each of outputWorkspaces with the geometry of
+    #instrumentWorkspace applied to its peaks
+
+    for outputWorkspace in outputWorkspaces:
+        ApplyInstrumentToPeaks(InputWorkspace=inputWorkspace,
+                               InstrumentWorkspace=instrumentWorkspace,
+                               OutputWorkspace=outputWorkspace)
+
+def geometryKey(instrumentName,calibrationFiles=[],logs=None,monitorList=None,recentre=False):
+
+    return parsHash(instrumentName,
+                    [fileHash(calibrationFile) for calibrationFile in calibrationFiles],
+                    logs,
+                    monitorList,
+                    recentre)
+
+def geometry(instrumentName,outputWorkspace,calibrationFiles=[],logs=None,monitorList=None,recentre=False,cacheDir=None,keep=True):
+
+    #clone of instrumentName's empty instrument workspace into outputWorkspace.
+    #logs (e.g. the SNAP det_arc/det_lin state parameters) are added as sample
+    #logs before the instrument is reloaded so they position the detectors,
+    #calibrationFiles are then applied in order and if recentre is True the
+    #sample is moved to the origin (see recentreSample)
+    #geometries that will be asked for again are kept in the ADS and, if
+    #cacheDir is given, on disk. keep=False builds straight into
+    #outputWorkspace for one-off geometries (e.g. a calibration just refined),
+    #the caller deletes it when done
+
+    if keep:
+        key = geometryKey(instrumentName,calibrationFiles,logs,monitorList,recentre)
+        cached = f"__geometry_{instrumentName}_{key}"
+    else:
+        cached,cacheDir = outputWorkspace,None
+
+    if not keep or not mtd.doesExist(cached):
+
+        cacheFile = None
+        if cacheDir is not None:
+            os.makedirs(cacheDir,exist_ok=True)
+            cacheFile = os.path.join(cacheDir,f"{instrumentName}_{key}.nxs")
+
+        if cacheFile is not None and os.path.exists(cacheFile):
+            LoadNexusProcessed(Filename=cacheFile,
+                               OutputWorkspace=cached)
+        else:
+            LoadEmptyInstrument(InstrumentName=instrumentName,
+                                OutputWorkspace=cached)
+
+            if logs is not None:
+                for log in logs:
+                    AddSampleLog(Workspace=cached,
+                                 LogName=log,LogText=str(logs[log]),
+                                 LogType='Number Series')
+
+                LoadInstrument(Workspace=cached,
+                               MonitorList=monitorList,
+                               RewriteSpectraMap='False',
+                               InstrumentName=instrumentName)
+
+            for calibrationFile in calibrationFiles:
+                applyCalibration(cached,calibrationFile)
+
+            if recentre:
+                recentreSample(cached)
+
+            if cacheFile is not None:
+                saveCached(SaveNexusProcessed,cached,cacheFile)
+
+    if keep:
+        CloneWorkspace(InputWorkspace=cached,
+                       OutputWorkspace=outputWorkspace)
+
+def superPixelSize(grouping):
+
+    #'2x2' -> 2, None -> 1 (no grouping)
+
+    if grouping is None:
+        return 1
+    rows,cols = [int(n) for n in str(grouping).lower().split('x')]
+    if rows != cols:
+        raise ValueError(f"only N x N grouping is supported, not {grouping}")
+    return rows
+
+def rectangularBanks(component):
+
+    #the rectangular detector banks below component (not their pixels)
+
+    if component.type() == 'RectangularDetector':
+        return [component]
+    if not hasattr(component,'nelements'):
+        return []
+    banks = []
+    for i in range(component.nelements()):
+        banks += rectangularBanks(component[i])
+    return banks
+
+def superPixelGrouping(instrumentWorkspace,n):
+
+    #name of a grouping workspace summing each n x n block of pixels of every
+    #rectangular bank of instrumentWorkspace's instrument into one spectrum.
+    #Groups only depend on detector IDs so are built once per instrument
+
+    inst = mtd[instrumentWorkspace].getInstrument()
+    cached = f"__superpixels_{inst.getName()}_{n}"
+
+    if not mtd.doesExist(cached):
+
+        ids,groups,nGroups = [],[],0
+        for bank in rectangularBanks(inst):
+            nx,ny = bank.xpixels(),bank.ypixels()
+            x,y = np.meshgrid(np.arange(nx),np.arange(ny),indexing='ij')
+            if bank.idfillbyfirst_y():
+                bankIds = bank.idstart()+x*bank.idstepbyrow()+y*bank.idstep()
+            else:
+                bankIds = bank.idstart()+y*bank.idstepbyrow()+x*bank.idstep()
+            #super-pixel rows of ceil(ny/n) along y, numbered from 1
+            groupRows = -(-ny//n)
+            ids.append(bankIds.ravel())
+            groups.append(nGroups+1+(x//n*groupRows+y//n).ravel())
+            nGroups += -(-nx//n)*groupRows
+        ids,groups = np.concatenate(ids),np.concatenate(groups)
+        order = np.argsort(groups,kind='stable')
+        ids,groups = ids[order],groups[order]
+
+        #the groups as a custom grouping string ('1+2+3,4+5+6,...' of detector
+        #IDs, group numbers follow the order) built with array operations, so
+        #the grouping workspace is filled by the algorithm rather than per
+        #spectrum in python. Detectors outside rectangular banks are left
+        #ungrouped (0)
+        separators = np.where(np.append(groups[1:] != groups[:-1],False),',','+')
+        separators[-1] = ''
+        grouping = ''.join(np.char.add(ids.astype(str),separators))
+
+        CreateGroupingWorkspace(InputWorkspace=instrumentWorkspace,
+                                CustomGroupingString=grouping,
+                                OutputWorkspace=cached)
+
+    return cached
+
+def groupPixels(workspace,n):
+
+    #sum workspace's events into n x n super-pixels in place. The grouped
+    #spectra keep the full resolution geometry, each is placed at the average
+    #position of its pixels, so no separate grouped DetCal is needed
+
+    if n <= 1:
+        return
+
+    GroupDetectors(InputWorkspace=workspace,
+                   CopyGroupingFromWorkspace=superPixelGrouping(workspace,n),
+                   PreserveEvents=True,
+                   OutputWorkspace=workspace)
+
+def clear():
+
+    #drop all cached geometry and groupings from the ADS (files on disk are
+    #left alone)
+
+    for name in mtd.getObjectNames():
+        if name.startswith('__geometry_') or name.startswith('__superpixels_'):
+            DeleteWorkspace(Workspace=name)
@@ -0,0 +1,111 @@
+# compact binary copies of the vanadium.py solid angle and flux outputs
+# each store is a small header, a detector ID index (sorted detector IDs and
+# the row each belongs to) and a float64 table, laid out so every part can be
+# memory mapped. Solid angle stores have one value per row (spectrum), flux
+# stores the cumulative flux of each row (bank) at the points of a shared k
+# grid. Concurrent readers share the page cache and only touch the pages of
+# the detectors they look up.
+#
+# Only writeWorkspace needs mantid, reading is plain numpy.
+#
+# layout (little endian): header, int32 ids[nIds], int32 rows[nIds],
+# float64 k[nPoints], float64 values[nRows, max(nPoints, 1)]
+import numpy as np
+
+import os
+import struct
+
+magic = b'SXLNORM1'
+header = struct.Struct('<8s8sqqq')
+headerSize = 64
+
+def write(filename, kind, detectorIDs, values, k=None):
+
+    # detectorIDs holds the detector IDs of each row of values, k the flux
+    # grid (None for solid angles). Written to a temporary file and renamed
+
+    ids = np.concatenate([np.asarray(rowIDs, dtype=np.int32) for rowIDs in detectorIDs])
+    rows = np.concatenate([np.full(len(rowIDs), row, dtype=np.int32) for row, rowIDs in enumerate(detectorIDs)])
+    order = np.argsort(ids, kind='stable')
+
+    k = np.zeros(0) if k is None else np.asarray(k, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(len(detectorIDs), max(len(k), 1))
+
+    tmpFile = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmpFile, 'wb') as f:
+        f.write(header.pack(magic, kind.encode().ljust(8), len(ids), len(detectorIDs), len(k)).ljust(headerSize, b'\0'))
+        f.write(ids[order].tobytes())
+        f.write(rows[order].tobytes())
+        f.write(k.tobytes())
+        f.write(values.tobytes())
+    os.replace(tmpFile, filename)
+
+def writeWorkspace(filename, kind, workspace, cumulative=False):
+
+    # store the Y values of a workspace (e.g. vanadium.py's sa or flux), k is
+    # the common X of flux (cumulative) workspaces
+
+    from mantid.simpleapi import mtd
+
+    ws = mtd[workspace]
+    detectorIDs = [ws.getSpectrum(i).getDetectorIDs() for i in range(ws.getNumberHistograms())]
+    y = ws.extractY()
+
+    k = None
+    if cumulative:
+        k = ws.readX(0)
+        if len(k) == y.shape[1]+1:
+            k = (k[:-1]+k[1:])/2
+
+    write(filename, kind, detectorIDs, y, k)
+
+def load(filename):
+
+    # memory mapped store, a dict of kind, ids, rows, k and values
+
+    with open(filename, 'rb') as f:
+        fileMagic, kind, nIds, nRows, nPoints = header.unpack(f.read(header.size))
+    if fileMagic != magic:
+        raise ValueError('{} is not a normalization store'.format(filename))
+
+    store = {'kind': kind.rstrip().decode()}
+    offset = headerSize
+    for name, dtype, shape in [('ids', np.int32, (nIds,)),
+                               ('rows', np.int32, (nIds,)),
+                               ('k', np.float64, (nPoints,)),
+                               ('values', np.float64, (nRows, max(nPoints, 1)))]:
+        if np.prod(shape) == 0:
+            store[name] = np.zeros(shape, dtype=dtype)
+        else:
+            store[name] = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+        offset += int(np.prod(shape))*np.dtype(dtype).itemsize
+    return store
+
+def rows(store, detectorIDs):
+
+    # row of each detector, -1 for detectors not in the store
+
+    detectorIDs = np.asarray(detectorIDs)
+    j = np.clip(np.searchsorted(store['ids'], detectorIDs), 0, len(store['ids'])-1)
+    found = store['ids'][j] == detectorIDs
+    return np.where(found, store['rows'][j], -1)
+
+def solidAngle(store, detectorIDs):
+
+    # solid angle of each detector, nan for detectors not in the store
+
+    row = rows(store, detectorIDs)
+    return np.where(row >= 0, store['values'][np.maximum(row, 0), 0], np.nan)
+
+def cumulativeFlux(store, detectorIDs, k):
+
+    # cumulative flux of each detector's bank at momentum k (scalar or one
+    # per detector), nan for detectors not in the store
+
+    row = rows(store, detectorIDs)
+    k = np.broadcast_to(k, row.shape)
+    flux = np.full(row.shape, np.nan)
+    for r in np.unique(row[row >= 0]):
+        select = row == r
+        flux[select] = np.interp(k[select], store['k'], store['values'][r])
+    return flux
@@ -0,0 +1,124 @@
+# staged SCDCalibratePanels refinement used by calibrate.py
+# refining L1, every bank and the sample position at once on the full peak set
+# is the slowest step of a calibration. refine() first optimises on a
+# stratified subsample (the strongest peaks of every bank, so no bank is left
+# unconstrained), then refines on the full set starting from the previous
+# stage's geometry with shrinking search radii. It stops as soon as no bank
+# moves or turns by more than the tolerances between stages.
+from mantid.simpleapi import *
+import numpy as np
+
+import os
+
+import instrumentCache as ic
+import peakFinding as pf
+
+def subsample(inputWorkspace,perBank,outputWorkspace):
+
+    #the perBank peaks with the highest signal/noise of each bank
+
+    columns = pf.peakColumns(inputWorkspace,['BankName','Signal/Noise'])
+    banks,signal = columns['BankName'],np.nan_to_num(columns['Signal/Noise'],nan=0)
+
+    keep = []
+    for bank in np.unique(banks):
+        index = np.flatnonzero(banks == bank)
+        keep.extend(index[np.argsort(signal[index])[::-1][:perBank]])
+
+    CreatePeaksWorkspace(InstrumentWorkspace=inputWorkspace,
+                         NumberOfPeaks=0,
+                         OutputWorkspace=outputWorkspace)
+
+    peaks,sampled = mtd[inputWorkspace],mtd[outputWorkspace]
+    for j in sorted(keep):
+        sampled.addPeak(peaks.getPeak(int(j)))
+
+def bankParameters(tableWorkspace):
+
+    #position (m) and rotation vector (degrees) of each component in an
+    #SCDCalibratePanels output table
+
+    table = mtd[tableWorkspace]
+    names = table.column('ComponentName')
+    position = np.column_stack([table.column(f"{x}position") for x in 'XYZ'])
+    axis = np.column_stack([table.column(f"{x}directionCosine") for x in 'XYZ'])
+    rotation = axis*np.array(table.column('RotationAngle'))[:,None]
+    return {name:(position[i],rotation[i]) for i,name in enumerate(names)}
+
+def largestChange(previous,current):
+
+    #largest translation and rotation of any component between two results
+
+    translation,rotation = 0,0
+    for name,(position,angle) in current.items():
+        if name in previous:
+            translation = max(translation,np.linalg.norm(position-previous[name][0]))
+            rotation = max(rotation,np.linalg.norm(angle-previous[name][1]))
+    return translation,rotation
+
+def calibratePanels(peaksWorkspace,lattice,outputName,radii,outdir):
+
+    a,b,c,alpha,beta,gamma = lattice
+
+    SCDCalibratePanels(PeakWorkspace=peaksWorkspace,
+                       RecalculateUB=True,
+                       a=a,
+                       b=b,
+                       c=c,
+                       alpha=alpha,
+                       beta=beta,
+                       gamma=gamma,
+                       OutputWorkspace='calibration_table',
+                       DetCalFilename=os.path.join(outdir,f"{outputName}.DetCal"),
+                       CSVFilename=os.path.join(outdir,f"{outputName}.csv"),
+                       XmlFilename=os.path.join(outdir,f"{outputName}.xml"),
+                       CalibrateT0=False,
+                       SearchRadiusT0=10,
+                       CalibrateL1=True,
+                       SearchRadiusL1=radii["L1"],
+                       CalibrateBanks=True,
+                       SearchRadiusTransBank=radii["TransBank"],
+                       SearchRadiusRotXBank=radii["RotBank"],
+                       SearchRadiusRotYBank=radii["RotBank"],
+                       SearchRadiusRotZBank=radii["RotBank"],
+                       VerboseOutput=True,
+                       SearchRadiusSamplePos=radii["SamplePos"],
+                       TuneSamplePosition=True,
+                       CalibrateSize=False,
+                       SearchRadiusSize=0.1,
+                       FixAspectRatio=True)
+
+def refine(peaksWorkspace,instrumentName,lattice,outdir,radii,perBank=20,
+           maxStages=4,shrink=0.3,tolerance=(1e-4,0.01),outputName='calibration'):
+
+    #refine the geometry of peaksWorkspace's panels, writing outputName.DetCal,
+    #.csv and .xml to outdir and the table of the final stage to
+    #calibration_table. lattice is (a,b,c,alpha,beta,gamma), radii the search
+    #radii of the coarse stage (L1, TransBank, RotBank and SamplePos), scaled
+    #by shrink for every later stage. Stops once no bank moves by more than
+    #tolerance (m, degrees) or after maxStages refinements of the full set
+
+    subsample(peaksWorkspace,perBank,'__stage_peaks')
+    print(f"Coarse panel refinement on {mtd['__stage_peaks'].getNumberPeaks()} of {mtd[peaksWorkspace].getNumberPeaks()} peaks")
+    calibratePanels('__stage_peaks',lattice,outputName,radii,outdir)
+    previous = bankParameters('calibration_table')
+
+    for stage in range(maxStages):
+        radii = {key:value*shrink for key,value in radii.items()}
+
+        ic.geometry(instrumentName,'__stage_inst',
+                    calibrationFiles=[os.path.join(outdir,f"{outputName}.xml")],
+                    keep=False)
+        ic.applyToPeaks('__stage_inst',peaksWorkspace,['__stage_peaks'])
+        DeleteWorkspace(Workspace='__stage_inst')
+
+        calibratePanels('__stage_peaks',lattice,outputName,radii,outdir)
+        current = bankParameters('calibration_table')
+
+        translation,rotation = largestChange(previous,current)
+        print(f"Panel refinement stage {stage+1}: largest change {translation:.2e} m, {rotation:.2e} deg")
+        previous = current
+        if translation < tolerance[0] and rotation < tolerance[1]:
+            break
+
+    DeleteWorkspace(Workspace='__stage_peaks')
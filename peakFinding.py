@@ -0,0 +1,568 @@
+# per-run peak finding and integration used by calibrate.py
+# runs are independent until they are combined, so they can either be processed
+# one after another or split over several worker processes. Workers are
+# separate python processes running this file, each handles a subset of runs
+# and saves its filtered peaks to a temporary file that is merged at the end.
+# Each stage's output can be cached per run (the md only on request, as it's
+# as large as the run) so reruns with new parameters (or after a crash) only
+# redo what changed. To bound memory a run can also be
+# converted and searched a few banks at a time (pars["chunk_banks"]), and
+# loading can be restricted to the banks and time of flight band that matter
+# (pars["selective_loading"]). In lite mode (pars["grouping"], e.g. '2x2')
+# pixels are summed into super-pixels before conversion.
+from mantid.simpleapi import *
+import numpy as np
+
+import os
+import sys
+import json
+import shutil
+import re
+import h5py
+import tempfile
+import subprocess
+
+from cacheTools import fileHash, parsHash, saveCached
+import instrumentCache as ic
+import stageTrace as st
+
+def stageKeys(filename,calibration_file,pars):
+
+    #cache keys for the md, found and integrated peaks of a run. Event files are
+    #too large to hash so the run is identified by name, size and mtime. Each
+    #key includes the previous stage's so a change propagates downstream, and
+    #sig_noise isn't part of any key as filtering is cheap and always re-run
+
+    run = os.path.basename(filename).split('.')[0]
+    stat = os.stat(filename)
+
+    chunking = [pars["chunk_banks"],pars["wavelength"]] if pars.get("chunk_banks") else []
+    selection = [pars["wavelength"],pars.get("banks")] if pars.get("selective_loading") else []
+    grouping = [pars["grouping"]] if pars.get("grouping") else []
+
+    md = parsHash(run,stat.st_size,stat.st_mtime,fileHash(calibration_file),
+                  pars["beamLineAxis0"],pars["beamLineAxis1"],pars["Q_max"],
+                  *chunking,*selection,*grouping)
+    found = parsHash(md,pars["d_max"],pars["max_peaks"],pars["density_threshold"])
+    integrated = parsHash(found,pars["peak_radii"])
+
+    return {"md":f"{run}_md_{md}.nxs",
+            "found":f"{run}_found_{found}.nxs",
+            "integrated":f"{run}_integrated_{integrated}.nxs"}
+
+#neutron time of flight (microseconds) per metre of flight path per angstrom
+tofPerMetreAngstrom = 252.778
+
+def detCalBanks(calibration_file):
+
+    #L1 and the shortest and longest L2 (m) of each bank of an ISAW DetCal,
+    #from the panel centres, sizes and orientations (the file is in cm)
+
+    L1,banks = None,{}
+    with open(calibration_file,'r') as f:
+        for line in f:
+            values = line.split()
+            if len(values) == 0:
+                continue
+            if values[0] == '7':
+                L1 = float(values[1])/100
+            elif values[0] == '5':
+                width,height = float(values[4])/100,float(values[5])/100
+                centre = np.array(values[8:11],dtype=float)/100
+                base,up = np.array(values[11:14],dtype=float),np.array(values[14:17],dtype=float)
+                corners = [centre+i*width/2*base+j*height/2*up for i in (-1,1) for j in (-1,1)]
+                #point of the panel closest to the sample at the origin
+                closest = (centre+np.clip(-centre@base,-width/2,width/2)*base
+                                 +np.clip(-centre@up,-height/2,height/2)*up)
+                banks[f"bank{values[1]}"] = (np.linalg.norm(closest),
+                                             max([np.linalg.norm(corner) for corner in corners]))
+    return L1,banks
+
+def tofLimits(calibration_file,wavelength,margin=0.02):
+
+    #time of flight band (microseconds) of each bank covering the wavelength
+    #band, widened by margin for sample offsets and moderator emission time
+
+    L1,banks = detCalBanks(calibration_file)
+    return {bank:((1-margin)*tofPerMetreAngstrom*(L1+L2min)*wavelength[0],
+                  (1+margin)*tofPerMetreAngstrom*(L1+L2max)*wavelength[1])
+            for bank,(L2min,L2max) in banks.items()}
+
+def loadSelection(filename,calibration_file,pars):
+
+    #(bank,tofLimits) for each bank of a run to load, limits are None for the
+    #whole bank. With pars["selective_loading"] each bank is limited to the
+    #pars["wavelength"] band and, if pars["banks"] is set (e.g. the banks with
+    #indexed peaks in an earlier pass), only those banks are loaded
+
+    banks = bankNames(filename)
+    if not pars.get("selective_loading"):
+        return [(bank,None) for bank in banks]
+
+    limits = tofLimits(calibration_file,pars["wavelength"])
+    if pars.get("banks") is not None:
+        banks = [bank for bank in banks if bank in pars["banks"]]
+    return [(bank,limits.get(bank)) for bank in banks]
+
+def loadBank(filename,calibration_file,pars,bank,limits=None):
+
+    #load one bank of a run into 'data', events outside limits (tofMin,tofMax)
+    #are dropped as they're read, with the calibration and goniometer set and
+    #pixels grouped by pars["grouping"]
+
+    tof = {} if limits is None else {"FilterByTofMin":limits[0],"FilterByTofMax":limits[1]}
+
+    LoadEventNexus(Filename=filename,
+                   BankName=bank,
+                   OutputWorkspace='data',
+                   **tof)
+
+    LoadIsawDetCal(InputWorkspace='data',
+                   Filename=calibration_file)
+
+    ic.groupPixels('data',ic.superPixelSize(pars.get("grouping")))
+
+    SetGoniometer(Workspace='data',
+                  Axis0=pars["beamLineAxis0"],
+                  Axis1=pars["beamLineAxis1"],
+                  Average=True)
+
+def reportLoading(filename,banks,loaded):
+
+    #events skipped by selective loading: banks not loaded are never read (8
+    #bytes per uncompressed event on disk) and no skipped event is held in
+    #memory (16 bytes per event)
+
+    events = bankEvents(filename)
+    total = sum(events.values())
+    read = sum([events[bank] for bank in banks])
+    print(f"{os.path.basename(filename)}: loaded {loaded} of {total} events from {len(banks)} of {len(events)} banks, "
+          f"{(total-read)*8/2**20:.1f} MB not read, {(total-loaded)*16/2**20:.1f} MB event memory saved")
+
+def convertRun(filename,calibration_file,pars):
+
+    #load a single run and convert it to Q_sample in 'md'
+
+    Q_max = pars["Q_max"]
+
+    if pars.get("selective_loading"):
+        #bank by bank, adding to 'md'
+        selection = loadSelection(filename,calibration_file,pars)
+        loaded = 0
+        for bank,limits in selection:
+            loadBank(filename,calibration_file,pars,bank,limits)
+            loaded += mtd['data'].getNumberEvents()
+            ConvertToMD(InputWorkspace='data',
+                        QDimensions='Q3D',
+                        dEAnalysisMode='Elastic',
+                        Q3DFrames='Q_sample',
+                        MinValues=[-Q_max,-Q_max,-Q_max],
+                        MaxValues=[+Q_max,+Q_max,+Q_max],
+                        OverwriteExisting=False,
+                        OutputWorkspace='md')
+            DeleteWorkspace(Workspace='data')
+        reportLoading(filename,[bank for bank,_ in selection],loaded)
+        return
+
+    LoadEventNexus(Filename=filename,
+                   OutputWorkspace='data')
+
+    LoadIsawDetCal(InputWorkspace='data',
+                   Filename=calibration_file)
+
+    #lite mode, sum pixels into super-pixels before conversion
+    ic.groupPixels('data',ic.superPixelSize(pars.get("grouping")))
+
+    SetGoniometer(Workspace='data',
+                  Axis0=pars["beamLineAxis0"],
+                  Axis1=pars["beamLineAxis1"],
+                #   Axis2=beamLineAxis0, #TODO automatically accommodate 1,2 or 3 axes
+                  Average=True)
+
+    ConvertToMD(InputWorkspace='data',
+                QDimensions='Q3D',
+                dEAnalysisMode='Elastic',
+                Q3DFrames='Q_sample',
+                MinValues=[-Q_max,-Q_max,-Q_max],
+                MaxValues=[+Q_max,+Q_max,+Q_max],
+                OutputWorkspace='md')
+
+    DeleteWorkspace(Workspace='data')
+
+def bankEvents(filename):
+
+    #number of events in each bank of a run, read from the NeXus file
+    #without loading any events
+
+    events = {}
+    with h5py.File(filename,'r') as f:
+        for entry in f.values():
+            for key in entry.keys():
+                if re.fullmatch(r'bank\d+_events',key):
+                    events[key[:-len('_events')]] = entry[key]['event_id'].shape[0]
+    return events
+
+def bankNames(filename):
+
+    #names of the banks with events in a run
+
+    return sorted(bankEvents(filename),key=lambda bank:int(bank[4:]))
+
+def findPeaksChunked(filename,calibration_file,pars,outputWorkspace='peaks_ws'):
+
+    #find and integrate peaks pars["chunk_banks"] banks at a time so only one
+    #group's events and md are ever in memory. Events are restricted to the
+    #pars["wavelength"] band before conversion. The density threshold and
+    #max_peaks are applied as for the whole run, but a peak split across
+    #groups is found in each of them
+
+    Q_max = pars["Q_max"]
+    wavelength = pars["wavelength"]
+    peak_radii = pars["peak_radii"]
+
+    selection = loadSelection(filename,calibration_file,pars)
+    nBanks = pars["chunk_banks"]
+
+    #events the whole run's md would hold, from the file headers
+    events = bankEvents(filename)
+    if pars.get("selective_loading"):
+        runEvents = sum([events[bank] for bank,_ in selection])
+    else:
+        runEvents = sum(events.values())
+
+    loaded = 0
+    chunkWorkspaces = []
+    for c in range(0,len(selection),nBanks):
+
+        group = selection[c:c+nBanks]
+        with st.stage('bank group',banks=','.join([bank for bank,_ in group])):
+
+            for bank,limits in group:
+
+                loadBank(filename,calibration_file,pars,bank,limits)
+                loaded += mtd['data'].getNumberEvents()
+
+                ConvertUnits(InputWorkspace='data',
+                             OutputWorkspace='data',
+                             Target='Wavelength')
+
+                CropWorkspace(InputWorkspace='data',
+                              OutputWorkspace='data',
+                              XMin=wavelength[0],
+                              XMax=wavelength[1])
+
+                #adds to the group's md if it already exists
+                ConvertToMD(InputWorkspace='data',
+                            QDimensions='Q3D',
+                            dEAnalysisMode='Elastic',
+                            Q3DFrames='Q_sample',
+                            MinValues=[-Q_max,-Q_max,-Q_max],
+                            MaxValues=[+Q_max,+Q_max,+Q_max],
+                            OverwriteExisting=False,
+                            OutputWorkspace='md')
+
+                DeleteWorkspace(Workspace='data')
+
+            ws = f"{outputWorkspace}_chunk{len(chunkWorkspaces)}"
+
+            #DensityThresholdFactor is relative to the md's average density.
+            #The group's md spans the whole run's Q box with a fraction of its
+            #events, so the factor is scaled up to the run's absolute threshold
+            density_threshold = pars["density_threshold"]*runEvents/max(mtd['md'].getNEvents(),1)
+
+            FindPeaksMD(InputWorkspace='md',
+                        PeakDistanceThreshold=2*np.pi/pars["d_max"],
+                        MaxPeaks=pars["max_peaks"],
+                        DensityThresholdFactor=density_threshold,
+                        OutputWorkspace=ws)
+
+            if mtd[ws].getNumberPeaks() > 0:
+                IntegratePeaksMD(InputWorkspace='md',
+                                 PeakRadius=peak_radii[0],
+                                 BackgroundInnerRadius=peak_radii[1],
+                                 BackgroundOuterRadius=peak_radii[2],
+                                 PeaksWorkspace=ws,
+                                 OutputWorkspace=ws,
+                                 Ellipsoid=True,
+                                 FixQAxis=True,
+                                 FixMajorAxisLength=False,
+                                 UseCentroid=True,
+                                 MaxIterations=3)
+
+            chunkWorkspaces.append(ws)
+            DeleteWorkspace(Workspace='md')
+
+    mergePeaks(chunkWorkspaces,outputWorkspace)
+    for ws in chunkWorkspaces:
+        DeleteWorkspace(Workspace=ws)
+
+    #FindPeaksMD keeps the max_peaks densest peaks of the run, here the
+    #densest of all groups (BinCount is the absolute density)
+    if mtd[outputWorkspace].getNumberPeaks() > pars["max_peaks"]:
+        density = np.sort(peakColumns(outputWorkspace,['BinCount'])['BinCount'])[::-1]
+        filterPeaks(outputWorkspace,[('BinCount','>=',density[pars["max_peaks"]-1])],outputWorkspace)
+
+    if pars.get("selective_loading"):
+        reportLoading(filename,[bank for bank,_ in selection],loaded)
+
+def findPeaks(filename,calibration_file,pars,outputWorkspace='peaks_ws',cacheDir=None):
+
+    #find, integrate and filter the peaks of a single run
+    #pars holds the calibration parameters set at the top of calibrate.py
+    #if cacheDir is given each stage's output is cached there and only the
+    #stages whose inputs changed are re-run. The md is only cached if
+    #pars["cache_md"] is set as it's as large as the run
+
+    cacheFiles = {}
+    if cacheDir is not None:
+        os.makedirs(cacheDir,exist_ok=True)
+        cacheFiles = {stage:os.path.join(cacheDir,name) for stage,name in
+                      stageKeys(filename,calibration_file,pars).items()
+                      if stage != "md" or pars.get("cache_md")}
+
+    def cached(stage):
+        return stage in cacheFiles and os.path.exists(cacheFiles[stage])
+
+    def makeMD():
+        if cached("md"):
+            LoadMD(Filename=cacheFiles["md"],OutputWorkspace='md')
+        else:
+            convertRun(filename,calibration_file,pars)
+            if "md" in cacheFiles:
+                saveCached(SaveMD,'md',cacheFiles["md"])
+
+    if cached("integrated"):
+        Load(Filename=cacheFiles["integrated"],OutputWorkspace=outputWorkspace)
+    elif pars.get("chunk_banks"):
+        #chunks are found and integrated together so only the result is cached
+        findPeaksChunked(filename,calibration_file,pars,outputWorkspace)
+        if "integrated" in cacheFiles:
+            saveCached(SaveNexus,outputWorkspace,cacheFiles["integrated"])
+    else:
+        makeMD()
+
+        if cached("found"):
+            Load(Filename=cacheFiles["found"],OutputWorkspace=outputWorkspace)
+        else:
+            FindPeaksMD(InputWorkspace='md',
+                        PeakDistanceThreshold=2*np.pi/pars["d_max"],
+                        MaxPeaks=pars["max_peaks"],
+                        DensityThresholdFactor=pars["density_threshold"],
+                        OutputWorkspace=outputWorkspace)
+            if "found" in cacheFiles:
+                saveCached(SaveNexus,outputWorkspace,cacheFiles["found"])
+
+        peak_radii = pars["peak_radii"]
+
+        IntegratePeaksMD(InputWorkspace='md',
+                         PeakRadius=peak_radii[0],
+                         BackgroundInnerRadius=peak_radii[1],
+                         BackgroundOuterRadius=peak_radii[2],
+                         PeaksWorkspace=outputWorkspace,
+                         OutputWorkspace=outputWorkspace,
+                         Ellipsoid=True,
+                         FixQAxis=True,
+                         FixMajorAxisLength=False,
+                         UseCentroid=True,
+                         MaxIterations=3)
+        if "integrated" in cacheFiles:
+            saveCached(SaveNexus,outputWorkspace,cacheFiles["integrated"])
+
+        DeleteWorkspace(Workspace='md')
+
+    filterPeaks(outputWorkspace,[('Signal/Noise','>',pars["sig_noise"])],outputWorkspace)
+
+def mergePeaks(inputWorkspaces,outputWorkspace='peaks'):
+
+    #combine peaks workspaces in one pass. Peaks are appended in place to a
+    #clone of the first workspace rather than re-combining (and copying) the
+    #growing output for every input as CombinePeaksWorkspaces would. The
+    #merge is built under a scratch name so outputWorkspace may also be one
+    #of the inputs
+
+    CloneWorkspace(InputWorkspace=inputWorkspaces[0],
+                   OutputWorkspace='__merged_peaks')
+
+    peaks = mtd['__merged_peaks']
+    for ws in inputWorkspaces[1:]:
+        other = mtd[ws]
+        for j in range(other.getNumberPeaks()):
+            peaks.addPeak(other.getPeak(j))
+
+    RenameWorkspace(InputWorkspace='__merged_peaks',
+                    OutputWorkspace=outputWorkspace)
+
+#comparisons understood by filterPeaks, as for FilterPeaks' Operator
+filterOperators = {'<':np.less,
+                   '>':np.greater,
+                   '=':np.equal,
+                   '!=':np.not_equal,
+                   '<=':np.less_equal,
+                   '>=':np.greater_equal}
+
+def peakColumns(workspace,variables):
+
+    #arrays of the peak values needed to evaluate variables, named as for
+    #FilterPeaks' FilterVariable (plus BankName)
+
+    ws = mtd[workspace]
+    columns = {}
+    for variable in set(variables):
+        if variable == 'h^2+k^2+l^2':
+            h,k,l = [np.array(ws.column(c)) for c in 'hkl']
+            columns[variable] = h**2+k**2+l**2
+        elif variable == 'h+k+l':
+            columns[variable] = np.array(ws.column('h'))+np.array(ws.column('k'))+np.array(ws.column('l'))
+        elif variable == 'QMod':
+            columns[variable] = np.array([q.norm() for q in ws.column('QLab')])
+        elif variable == 'Signal/Noise':
+            intensity,sigma = np.array(ws.column('Intens')),np.array(ws.column('SigInt'))
+            with np.errstate(divide='ignore',invalid='ignore'):
+                columns[variable] = intensity/sigma
+        elif variable == 'Intensity':
+            columns[variable] = np.array(ws.column('Intens'))
+        else:
+            #Wavelength, DSpacing, TOF, RunNumber, BankName, ...
+            columns[variable] = np.array(ws.column(variable))
+    return columns
+
+def filterPeaks(inputWorkspace,conditions,outputWorkspace):
+
+    #keep the peaks satisfying every (variable, operator, value) condition,
+    #e.g. [('h^2+k^2+l^2','!=',0),('QMod','>',0),('BankName','!=','')].
+    #Equivalent to chaining FilterPeaks but the columns are read once, the
+    #conditions are evaluated as array masks and the output is built in a
+    #single pass rather than copying the whole table for every condition
+
+    columns = peakColumns(inputWorkspace,[variable for variable,_,_ in conditions])
+
+    keep = np.ones(mtd[inputWorkspace].getNumberPeaks(),dtype=bool)
+    for variable,operator,value in conditions:
+        keep &= filterOperators[operator](columns[variable],value)
+
+    if keep.all():
+        if inputWorkspace != outputWorkspace:
+            CloneWorkspace(InputWorkspace=inputWorkspace,
+                           OutputWorkspace=outputWorkspace)
+        return
+
+    #empty workspace with the input's instrument, sample and UB
+    CreatePeaksWorkspace(InstrumentWorkspace=inputWorkspace,
+                         NumberOfPeaks=0,
+                         OutputWorkspace='__filtered_peaks')
+
+    peaks,filtered = mtd[inputWorkspace],mtd['__filtered_peaks']
+    for j in np.flatnonzero(keep):
+        filtered.addPeak(peaks.getPeak(int(j)))
+
+    RenameWorkspace(InputWorkspace='__filtered_peaks',
+                    OutputWorkspace=outputWorkspace)
+
+#pars that don't change the peaks found: restricting loading to the banks
+#with peaks and whether the md is cached
+peakSetIgnored = ["banks","cache_md"]
+
+def peakSetKey(calibration_file,pars):
+
+    #peaks stored by savePeakSet can only be extended with peaks found with
+    #the same DetCal and parameters (except peakSetIgnored)
+
+    return parsHash(fileHash(calibration_file),{key:value for key,value in pars.items() if key not in peakSetIgnored})
+
+def loadPeakSet(filename,key,outputWorkspace):
+
+    #load peaks saved by savePeakSet into outputWorkspace and return the runs
+    #they were found from, or None if there are none stored for key
+
+    runFile = f"{os.path.splitext(filename)[0]}.json"
+    if not (os.path.exists(filename) and os.path.exists(runFile)):
+        return None
+    with open(runFile,'r') as f:
+        stored = json.load(f)
+    if stored["key"] != key:
+        return None
+
+    Load(Filename=filename,OutputWorkspace=outputWorkspace)
+    return stored["runs"]
+
+def savePeakSet(inputWorkspace,filename,key,runs):
+
+    #save the peaks found from runs (names of the run files), with a json
+    #sidecar recording the runs, so later runs can be added incrementally
+
+    saveCached(SaveNexus,inputWorkspace,filename)
+    with open(f"{os.path.splitext(filename)[0]}.json",'w') as f:
+        json.dump({"key":key,"runs":runs},f,indent=1)
+
+def processRuns(filenames,calibration_file,pars,outFile=None,outputWorkspace='peaks',cacheDir=None):
+
+    #find peaks for each run in turn and merge them into outputWorkspace
+    #if outFile is given the merged peaks are also saved there
+
+    runWorkspaces = []
+    for i,filename in enumerate(filenames):
+        print(f"Working on {os.path.basename(filename)} ({(i+1)}/{len(filenames)} runs)", end="\r")
+        ws = f"peaks_ws_{i}"
+        with st.stage('run',run=os.path.basename(filename)):
+            findPeaks(filename,calibration_file,pars,outputWorkspace=ws,cacheDir=cacheDir)
+        runWorkspaces.append(ws)
+    print()
+
+    mergePeaks(runWorkspaces,outputWorkspace)
+    for ws in runWorkspaces:
+        DeleteWorkspace(Workspace=ws)
+
+    if outFile is not None:
+        SaveNexus(InputWorkspace=outputWorkspace,Filename=outFile)
+
+def processRunsParallel(filenames,calibration_file,pars,nWorkers,outputWorkspace='peaks',cacheDir=None):
+
+    #split filenames over nWorkers worker processes and merge their peaks
+
+    nWorkers = max(1,min(nWorkers,len(filenames)))
+    if nWorkers == 1:
+        processRuns(filenames,calibration_file,pars,outputWorkspace=outputWorkspace,cacheDir=cacheDir)
+        return
+
+    tmpDir = tempfile.mkdtemp(prefix='sxlPeaks_')
+    try:
+        workers = []
+        for w in range(nWorkers):
+            job = {"filenames":list(filenames[w::nWorkers]),
+                   "calibration_file":calibration_file,
+                   "pars":pars,
+                   "cacheDir":cacheDir,
+                   "outFile":os.path.join(tmpDir,f"peaks_{w}.nxs")}
+            jobFile = os.path.join(tmpDir,f"job_{w}.json")
+            with open(jobFile,'w') as f:
+                json.dump(job,f)
+            proc = subprocess.Popen([sys.executable,os.path.abspath(__file__),jobFile])
+            workers.append((proc,job["outFile"]))
+
+        print(f"Finding and integrating peaks for {len(filenames)} runs on {nWorkers} workers")
+        failed = [proc.args[-1] for proc,_ in workers if proc.wait() != 0]
+        if len(failed) != 0:
+            raise RuntimeError(f"peak finding failed for worker jobs: {failed}")
+
+        workerWorkspaces = []
+        for w,(proc,outFile) in enumerate(workers):
+            ws = f"peaks_worker_{w}"
+            Load(Filename=outFile,OutputWorkspace=ws)
+            workerWorkspaces.append(ws)
+
+        mergePeaks(workerWorkspaces,outputWorkspace)
+        for ws in workerWorkspaces:
+            DeleteWorkspace(Workspace=ws)
+    finally:
+        shutil.rmtree(tmpDir,ignore_errors=True)
+
+if __name__ == "__main__":
+
+    #worker process, the only argument is the json job file written above
+    st.enableFromEnvironment(globals())
+
+    with open(sys.argv[1],'r') as f:
+        job = json.load(f)
+
+    processRuns(job["filenames"],job["calibration_file"],job["pars"],
+                outFile=job["outFile"],cacheDir=job["cacheDir"])
@@ -0,0 +1,376 @@
+# single crystal reduction driven by a yaml file such as Yb3Al5O12.yaml
+# every run is binned with MDNorm into the Normalization grid and added to
+# memory-mapped accumulators on disk, so the grid never has to be held in
+# memory more than once per worker. Runs are split into chunks that are
+# processed by separate worker processes (this file run with --worker and a
+# json job), each with its own accumulators which are summed at the end.
+# If Normalization: Symmetry names a point group, the grid is folded into the
+# asymmetric unit of its Laue class as it is accumulated and only the unique
+# voxels are stored, see symmetryOrbits and expand. Grouping (e.g. 2x2) sums
+# pixels into super-pixels for quick looks, null for full resolution.
+#
+# usage: python reduction.py Yb3Al5O12.yaml [number of workers]
+from mantid.simpleapi import *
+import numpy as np
+import yaml
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+from mantid.geometry import PointGroupFactory
+from mantid.kernel import V3D
+
+import instrumentCache as ic
+import stageTrace as st
+
+file_directory = '/SNS/{}/IPTS-{}/nexus/'
+file_name = '{}_{}.nxs.h5'
+
+def parseRuns(runs):
+
+    #run numbers from an int, list or string like '46742:46752,46760'
+    #ranges are inclusive as for Mantid's Load
+
+    if isinstance(runs, int):
+        return [runs]
+    if isinstance(runs, list):
+        return [run for item in runs for run in parseRuns(item)]
+    numbers = []
+    for part in str(runs).split(','):
+        if ':' in part:
+            first, last = part.split(':')
+            numbers += list(range(int(first), int(last)+1))
+        else:
+            numbers.append(int(part))
+    return numbers
+
+def loadConfig(filename):
+
+    with open(filename, 'r') as f:
+        config = yaml.safe_load(f)
+
+    config['Runs'] = parseRuns(config['Runs'])
+    return config
+
+def gridShape(config):
+
+    return tuple(config['Normalization']['Bins'])
+
+def accumulatorNames(config):
+
+    names = ['data', 'norm']
+    if config.get('BackgroundFile') is not None:
+        names += ['bkg_data', 'bkg_norm']
+    return names
+
+def openAccumulators(directory, config, shape, mode='r+'):
+
+    #memory-mapped .npy accumulators, mode 'w+' creates them filled with zeros
+
+    return {name: np.lib.format.open_memmap(os.path.join(directory, '{}.npy'.format(name)),
+                                            mode=mode, dtype=np.float64, shape=shape)
+            for name in accumulatorNames(config)}
+
+def orbitFile(config):
+
+    return os.path.join(config['OutputPath'], config['OutputName'], 'orbits.npy')
+
+def symmetryOperations(config):
+
+    #Laue class operations of Normalization: Symmetry as voxel index maps.
+    #Each operation is returned as a list of (source axis, flip) per grid axis
+    #and must map the grid onto itself, i.e. be a signed permutation of the
+    #projections with matching bins and extents
+
+    normalization = config['Normalization']
+    P = np.array(normalization['Projections'], dtype=float).T
+    bins = normalization['Bins']
+    extents = normalization['Extents']
+
+    pg = PointGroupFactory.createPointGroup(normalization['Symmetry'])
+    laue = PointGroupFactory.createPointGroup(pg.getLauePointGroupSymbol())
+
+    operations = []
+    for op in laue.getSymmetryOperations():
+        W = np.column_stack([np.array(op.transformHKL(V3D(*e))) for e in np.eye(3)])
+        M = np.linalg.solve(P, W @ P)
+        if not np.allclose(M, np.round(M)) or not np.allclose(np.abs(np.round(M)).sum(axis=1), 1):
+            raise ValueError('symmetry operation {} does not map the grid onto itself'.format(op.getIdentifier()))
+        M = np.round(M).astype(int)
+        mapping = []
+        for a in range(3):
+            b = int(np.flatnonzero(M[a])[0])
+            flip = M[a, b] < 0
+            image = [-extents[b][1], -extents[b][0]] if flip else extents[b]
+            if bins[a] != bins[b] or not np.allclose(extents[a], image):
+                raise ValueError('symmetry operation {} does not map the grid onto itself'.format(op.getIdentifier()))
+            mapping.append((b, flip))
+        operations.append(mapping)
+    return operations
+
+def symmetryOrbits(config):
+
+    #index of the unique (asymmetric unit) voxel each grid voxel folds onto.
+    #Every voxel is labelled by the smallest flat index in its orbit and the
+    #labels are then numbered consecutively
+
+    shape = gridShape(config)
+    indices = np.indices(shape, dtype=np.int32)
+    flat = np.arange(np.prod(shape), dtype=np.int64).reshape(shape)
+
+    representative = flat.copy()
+    for mapping in symmetryOperations(config):
+        image = [shape[b]-1-indices[b] if flip else indices[b] for b, flip in mapping]
+        np.minimum(representative, np.ravel_multi_index(image, shape), out=representative)
+
+    orbits = np.unique(representative, return_inverse=True)[1]
+    return orbits.reshape(shape).astype(np.int32)
+
+def loadOrbits(config):
+
+    #memory-mapped orbits written by reduceAll, None if not folding
+
+    if config['Normalization'].get('Symmetry') is None:
+        return None
+    return np.load(orbitFile(config), mmap_mode='r')
+
+def accumulatorShape(config, orbits):
+
+    return gridShape(config) if orbits is None else (int(orbits.max())+1,)
+
+def expand(outputDirectory, name='normalized', s=slice(None)):
+
+    #full grid values of an output array, or just the slab s along the first
+    #axis, expanding folded outputs from their unique voxels on demand
+
+    values = np.load(os.path.join(outputDirectory, '{}.npy'.format(name)), mmap_mode='r')
+    orbits = os.path.join(outputDirectory, 'orbits.npy')
+    if not os.path.exists(orbits):
+        return values[s]
+    return values[np.load(orbits, mmap_mode='r')[s]]
+
+def binningParameters(config):
+
+    #MDNorm projections and binning, extents are the outer bin edges
+
+    normalization = config['Normalization']
+    pars = {}
+    for i, (projection, extents, bins) in enumerate(zip(normalization['Projections'],
+                                                       normalization['Extents'],
+                                                       normalization['Bins'])):
+        step = (extents[1]-extents[0])/bins
+        pars['QDimension{}'.format(i)] = ','.join([str(val) for val in projection])
+        pars['Dimension{}Name'.format(i)] = 'QDimension{}'.format(i)
+        pars['Dimension{}Binning'.format(i)] = '{},{},{}'.format(extents[0], step, extents[1])
+    return pars
+
+def loadNormalization(config):
+
+    #solid angle and flux from vanadium.py, returns the flux momentum range
+
+    LoadNexus(Filename=config['VanadiumFile'], OutputWorkspace='sa')
+    LoadNexus(Filename=config['FluxFile'], OutputWorkspace='flux')
+
+    if config.get('MaskFile') is not None:
+        LoadMask(Instrument=config['Instrument'],
+                 InputFile=config['MaskFile'],
+                 RefWorkspace='sa',
+                 OutputWorkspace='mask')
+        MaskDetectors(Workspace='sa', MaskedWorkspace='mask')
+
+    #super-pixel solid angles for grouped (quick-look) reductions
+    ic.groupPixels('sa', ic.superPixelSize(config.get('Grouping')))
+
+    x = mtd['flux'].readX(0)
+    return x[0], x[-1]
+
+def convertRun(config, filename, k_min, k_max, outputWorkspace):
+
+    #load a run and convert it to Q_sample for MDNorm
+
+    LoadEventNexus(Filename=filename, OutputWorkspace='data')
+
+    if config.get('MaskFile') is not None:
+        MaskDetectors(Workspace='data', MaskedWorkspace='mask')
+
+    if config.get('DetectorCalibration') is not None:
+        ic.applyCalibration('data', config['DetectorCalibration'])
+
+    ic.groupPixels('data', ic.superPixelSize(config.get('Grouping')))
+
+    SetGoniometer(Workspace='data', Goniometer='Universal')
+
+    ConvertUnits(InputWorkspace='data', OutputWorkspace='data', Target='Momentum')
+
+    CropWorkspaceForMDNorm(InputWorkspace='data',
+                           XMin=k_min,
+                           XMax=k_max,
+                           OutputWorkspace='data')
+
+    LoadIsawUB(InputWorkspace='data', Filename=config['UBFile'])
+
+    Q_max = 2*k_max
+
+    ConvertToMD(InputWorkspace='data',
+                QDimensions='Q3D',
+                dEAnalysisMode='Elastic',
+                Q3DFrames='Q_sample',
+                MinValues=[-Q_max,-Q_max,-Q_max],
+                MaxValues=[+Q_max,+Q_max,+Q_max],
+                OutputWorkspace=outputWorkspace)
+
+    DeleteWorkspace(Workspace='data')
+
+def reduceRuns(config, runs, accumulatorDirectory):
+
+    #bin each run and add it to the accumulators in accumulatorDirectory
+
+    k_min, k_max = loadNormalization(config)
+    binning = binningParameters(config)
+
+    background = {}
+    if config.get('BackgroundFile') is not None:
+        convertRun(config, config['BackgroundFile'], k_min, k_max, 'bkg_md')
+        background = {'BackgroundWorkspace': 'bkg_md',
+                      'OutputBackgroundDataWorkspace': 'bkg_data',
+                      'OutputBackgroundNormalizationWorkspace': 'bkg_norm'}
+
+    orbits = loadOrbits(config)
+    accumulators = openAccumulators(accumulatorDirectory, config, accumulatorShape(config, orbits))
+
+    directory = file_directory.format(config['Instrument'], config['IPTS'])
+
+    for i, run in enumerate(runs):
+
+        print('Working on run {} ({}/{} runs)'.format(run, i+1, len(runs)), end='\r')
+
+        filename = os.path.join(directory, file_name.format(config['Instrument'], run))
+
+        with st.stage('run', run=run):
+
+            convertRun(config, filename, k_min, k_max, 'md')
+
+            MDNorm(InputWorkspace='md',
+                   SolidAngleWorkspace='sa',
+                   FluxWorkspace='flux',
+                   RLU=True,
+                   OutputWorkspace='normalized',
+                   OutputDataWorkspace='data',
+                   OutputNormalizationWorkspace='norm',
+                   **binning,
+                   **background)
+
+            for name, accumulator in accumulators.items():
+                signal = mtd[name].getSignalArray()
+                if orbits is None:
+                    accumulator += signal
+                else:
+                    accumulator += np.bincount(orbits.ravel(), weights=signal.ravel(), minlength=accumulator.size)
+                DeleteWorkspace(Workspace=name)
+
+            DeleteWorkspace(Workspace='md')
+            DeleteWorkspace(Workspace='normalized')
+
+    for accumulator in accumulators.values():
+        accumulator.flush()
+    print()
+
+def combine(config, workerDirectories, outputDirectory, slab=8):
+
+    #sum the workers' accumulators into outputDirectory and write the
+    #normalized result, working slab by slab along the first axis so only a
+    #few slabs of the grid are ever in memory
+
+    shape = accumulatorShape(config, loadOrbits(config))
+
+    totals = openAccumulators(outputDirectory, config, shape, mode='w+')
+    partials = [openAccumulators(directory, config, shape) for directory in workerDirectories]
+
+    normalized = np.lib.format.open_memmap(os.path.join(outputDirectory, 'normalized.npy'),
+                                           mode='w+', dtype=np.float64, shape=shape)
+
+    #folded accumulators are small enough to do at once
+    step = slab if len(shape) > 1 else shape[0]
+
+    for i in range(0, shape[0], step):
+        s = slice(i, i+step)
+        for name, total in totals.items():
+            for partial in partials:
+                total[s] += partial[name][s]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalized[s] = totals['data'][s]/totals['norm'][s]
+            if 'bkg_data' in totals:
+                normalized[s] -= totals['bkg_data'][s]/totals['bkg_norm'][s]
+
+    for total in totals.values():
+        total.flush()
+    normalized.flush()
+
+def reduceAll(config, nWorkers=1):
+
+    #reduce all runs in config on nWorkers worker processes, results are
+    #written as .npy files to OutputPath/OutputName/ with a json description
+
+    runs = config['Runs']
+    nWorkers = max(1, min(nWorkers, len(runs)))
+
+    outputDirectory = os.path.join(config['OutputPath'], config['OutputName'])
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    symmetry = config['Normalization'].get('Symmetry')
+    if symmetry is not None:
+        np.save(orbitFile(config), symmetryOrbits(config))
+    elif os.path.exists(orbitFile(config)):
+        os.remove(orbitFile(config))
+
+    shape = accumulatorShape(config, loadOrbits(config))
+
+    tmpDir = tempfile.mkdtemp(prefix='sxlReduction_', dir=outputDirectory)
+    try:
+        workers = []
+        for w in range(nWorkers):
+            workerDirectory = os.path.join(tmpDir, 'worker_{}'.format(w))
+            os.makedirs(workerDirectory)
+            openAccumulators(workerDirectory, config, shape, mode='w+')
+            job = {'config': config,
+                   'runs': runs[w::nWorkers],
+                   'accumulatorDirectory': workerDirectory}
+            jobFile = os.path.join(tmpDir, 'job_{}.json'.format(w))
+            with open(jobFile, 'w') as f:
+                json.dump(job, f)
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', jobFile])
+            workers.append((proc, workerDirectory))
+
+        print('Reducing {} runs on {} workers'.format(len(runs), nWorkers))
+        failed = [proc.args[-1] for proc, _ in workers if proc.wait() != 0]
+        if len(failed) != 0:
+            raise RuntimeError('reduction failed for worker jobs: {}'.format(failed))
+
+        combine(config, [directory for _, directory in workers], outputDirectory)
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    normalization = config['Normalization']
+    with open(os.path.join(outputDirectory, 'grid.json'), 'w') as f:
+        json.dump({'Runs': runs,
+                   'Projections': normalization['Projections'],
+                   'Extents': normalization['Extents'],
+                   'Bins': normalization['Bins'],
+                   'Symmetry': symmetry,
+                   'Arrays': accumulatorNames(config)+['normalized']}, f, indent=1)
+
+if __name__ == '__main__':
+
+    if sys.argv[1] == '--worker':
+        st.enableFromEnvironment(globals(), ic)
+        with open(sys.argv[2], 'r') as f:
+            job = json.load(f)
+        reduceRuns(job['config'], job['runs'], job['accumulatorDirectory'])
+    else:
+        config = loadConfig(sys.argv[1])
+        nWorkers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        reduceAll(config, nWorkers)
@@ -0,0 +1,92 @@
+# run metadata read straight from the NeXus file headers
+# a run's state only depends on a few logs (the detector arcs and linear
+# positions, requested wavelength, chopper frequency and guide position), so
+# a run list can be screened without mantid or a calibrationObject per run.
+# Only those DASlogs and the goniometer motors are read with h5py, the event
+# data is never touched. Files are read one after another: h5py serialises
+# every HDF5 call behind one lock so threads don't overlap, and forking
+# workers isn't safe once mantid has started. The state key is a quick
+# screen, the stateID resolved by SNAPTools remains authoritative.
+import numpy as np
+import h5py
+
+import glob
+
+import calibrationObject as calObj
+
+#logs defining the state (as used by SNAPTools.StateFromRunFunction) and
+#the resolution they are compared at
+stateLogs = {"det_arc1":0.01,
+             "det_arc2":0.01,
+             "det_lin1":0.0001,
+             "det_lin2":0.0001,
+             "BL3:Chop:Skf1:WavelengthUserReq":0.01,
+             "BL3:Det:TH:BL:Frequency":1,
+             "BL3:Mot:OpticsPos:Pos":1}
+goniometerLogs = {"omega":"BL3:Mot:omega",
+                  "phi":"BL3:Mot:phi"}
+
+nexusPattern = "/SNS/SNAP/IPTS-*/nexus/SNAP_{}.nxs.h5"
+
+def nexusFile(runNumber,stateIndex):
+
+    #run's NeXus file, from the state index if it has been seen before,
+    #otherwise searched for in the IPTS directories. None if not found
+
+    entry = stateIndex.get(str(runNumber))
+    if entry is not None:
+        return entry["stateDict"]["nxsFile"]
+    found = glob.glob(nexusPattern.format(runNumber))
+    return found[0] if len(found) != 0 else None
+
+def logValue(daslogs,name):
+
+    #time averaged value of a DASlog, or the mean of its values if the file
+    #doesn't have the average
+
+    log = daslogs[name]
+    if "average_value" in log:
+        return float(np.ravel(log["average_value"][()])[0])
+    return float(np.mean(log["value"][()]))
+
+def readRun(runNumber,filename):
+
+    #state and goniometer logs of one run, None values for anything missing
+
+    row = {"run":runNumber,"nxsFile":filename}
+    row.update({name:None for name in list(stateLogs)+list(goniometerLogs)})
+    if filename is None:
+        return row
+
+    try:
+        with h5py.File(filename,'r') as f:
+            daslogs = f["entry/DASlogs"]
+            for name in stateLogs:
+                if name in daslogs:
+                    row[name] = logValue(daslogs,name)
+            for name,log in goniometerLogs.items():
+                if log in daslogs:
+                    row[name] = logValue(daslogs,log)
+    except (OSError,KeyError):
+        print(f"WARNING couldn't read logs from:{filename}")
+    return row
+
+def stateKey(row):
+
+    #state logs rounded to their resolution, None if any are missing
+
+    if any(row[name] is None for name in stateLogs):
+        return None
+    return tuple(round(round(row[name]/step)*step,10) for name,step in stateLogs.items())
+
+def runTable(runs):
+
+    #table (list of dicts, in the order of runs) of each run's nxsFile, state
+    #logs, goniometer angles and state (see stateKey)
+
+    stateIndex = calObj.loadStateIndex()
+
+    table = [readRun(run,nexusFile(run,stateIndex)) for run in runs]
+    for row in table:
+        row["state"] = stateKey(row)
+    return table
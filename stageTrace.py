@@ -0,0 +1,196 @@
+# timing and memory trace of the Mantid algorithm calls made by the scripts
+# instrument() wraps every algorithm function in a namespace (a script's
+# globals() or a module using "from mantid.simpleapi import *") so each call
+# records its wall and cpu time, the process's current RSS, the peak RSS
+# reached during the call and the number of events and memory size of its
+# output workspace. stage() groups
+# calls, e.g. per run. write() saves everything in Chrome trace format (json)
+# which can be opened with chrome://tracing or https://ui.perfetto.dev.
+#
+# Worker processes inherit the trace through the SXL_TRACE environment
+# variable, call enableFromEnvironment() and write their own part file, which
+# the main process merges when it writes the trace.
+from mantid.api import AlgorithmFactory, AnalysisDataService
+import mantid.simpleapi as simpleapi
+
+import os
+import glob
+import json
+import time
+import atexit
+import resource
+import functools
+import contextlib
+
+traceFile = None
+events = []
+_context = []
+#peak RSS (MB) seen so far by each open stage or call, innermost last
+_peaks = []
+
+def enable(filename):
+
+    global traceFile
+    traceFile = os.path.abspath(filename)
+    if not traceFile.endswith('.part'):
+        os.environ['SXL_TRACE'] = traceFile
+        for part in glob.glob('{}.*.part'.format(traceFile)):
+            os.remove(part)
+    atexit.register(write)
+
+def enableFromEnvironment(*namespaces):
+
+    #for worker processes, trace into a part file next to the main trace
+
+    if os.environ.get('SXL_TRACE') is not None:
+        enable('{}.{}.part'.format(os.environ['SXL_TRACE'], os.getpid()))
+        instrument(*namespaces)
+
+def memory():
+
+    #current resident set size in MB
+
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1])*resource.getpagesize()/2**20
+
+def highWaterMark():
+
+    #peak resident set size in MB since the last resetPeak (VmHWM), the
+    #lifetime peak where /proc/self/status doesn't have it
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/2**10
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+def resetPeak():
+
+    #start a stage or call with its own peak: the peak so far is passed on
+    #to the enclosing ones, then the kernel's high-water mark is reset to the
+    #current RSS (if /proc/self/clear_refs can't be written the peak of the
+    #enclosing stage or the lifetime peak is reported)
+
+    peak = highWaterMark()
+    _peaks[:] = [max(outer, peak) for outer in _peaks]
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    _peaks.append(0.0)
+
+def stagePeak():
+
+    #peak RSS of the innermost stage or call, which the enclosing ones saw too
+
+    peak = max(_peaks.pop(), highWaterMark())
+    _peaks[:] = [max(outer, peak) for outer in _peaks]
+    return peak
+
+def workspaceSize(kwargs):
+
+    #events and memory of the workspace an algorithm wrote to
+
+    for key in ['OutputWorkspace', 'Workspace', 'InputWorkspace', 'PeaksWorkspace']:
+        name = kwargs.get(key)
+        if isinstance(name, str) and AnalysisDataService.doesExist(name):
+            ws = AnalysisDataService[name]
+            size = {'workspace': name, 'size_mb': ws.getMemorySize()/2**20}
+            if hasattr(ws, 'getNumberEvents'):
+                size['events'] = ws.getNumberEvents()
+            return size
+    return {}
+
+@contextlib.contextmanager
+def stage(name, category='stage', **info):
+
+    #record the enclosed block, info (e.g. run=...) is attached to it and to
+    #everything recorded inside it
+
+    if traceFile is None:
+        yield
+        return
+
+    _context.append(info)
+    start = clock()
+    resetPeak()
+    try:
+        yield
+    finally:
+        peak = stagePeak()
+        _context.pop()
+        args = {}
+        for outer in _context+[info]:
+            args.update(outer)
+        record(name, category, start, args, peak)
+
+def clock():
+
+    #epoch time (so traces from different processes line up), precise
+    #elapsed time and cpu time
+
+    return time.time(), time.perf_counter(), time.process_time()
+
+def record(name, category, start, args, peak):
+
+    epoch, wall, cpu = start
+    rss = memory()
+    duration = time.perf_counter()-wall
+    args.update({'cpu_s': time.process_time()-cpu, 'rss_mb': rss, 'peak_rss_mb': peak})
+    events.append({'name': name, 'cat': category, 'ph': 'X',
+                   'ts': epoch*1e6, 'dur': duration*1e6,
+                   'pid': os.getpid(), 'tid': 0, 'args': args})
+    events.append({'name': 'memory', 'ph': 'C', 'ts': (epoch+duration)*1e6,
+                   'pid': os.getpid(), 'args': {'rss_mb': rss}})
+
+def traced(name, function):
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if traceFile is None:
+            return function(*args, **kwargs)
+        start = clock()
+        resetPeak()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            peak = stagePeak()
+        info = {}
+        for outer in _context:
+            info.update(outer)
+        info.update(workspaceSize(kwargs))
+        record(name, 'algorithm', start, info, peak)
+        return result
+
+    return wrapper
+
+def instrument(*namespaces):
+
+    #wrap the algorithm functions of each namespace (a dict or a module)
+
+    for namespace in namespaces:
+        if not isinstance(namespace, dict):
+            namespace = vars(namespace)
+        for name, value in list(namespace.items()):
+            if value is getattr(simpleapi, name, None) and AlgorithmFactory.exists(name):
+                namespace[name] = traced(name, value)
+
+def write():
+
+    #write the trace, the main process also merges any worker part files
+
+    if traceFile is None:
+        return
+
+    if not traceFile.endswith('.part'):
+        for part in glob.glob('{}.*.part'.format(traceFile)):
+            with open(part, 'r') as f:
+                events.extend(json.load(f)['traceEvents'])
+            os.remove(part)
+
+    with open(traceFile, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
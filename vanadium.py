@@ -1,10 +1,16 @@
-# import mantid algorithms, numpy and matplotlib
+# import mantid algorithms and numpy
 from mantid.simpleapi import *
-import matplotlib.pyplot as plt
 import numpy as np
 
 import os
-import scipy.optimize
+
+import fluxFit as ff
+import fluxReport as fr
+import instrumentCache as ic
+import stageTrace as st
+import absorptionCache as ac
+import normalizationStore as ns
+import vanadiumCorrections as vc
 
 instrument = 'TOPAZ'
 output_directory = '/SNS/TOPAZ/shared/Vanadium/2022C_1202_AG/'
@@ -25,12 +31,31 @@ run_nos = [46757]
 k_min, k_max = 1.8, 18
 tof_min, tof_max = None, None
 
+stream_runs = False # load vanadium runs one at a time into a compressed sum to bound memory
+
+sample_geometry = {'Shape': 'Sphere', 'Radius': 0.2,'Center': [0.,0.,0.]}
+sample_material = {'ChemicalFormula': 'V', 'UnitCellVolume': 27.642, 'ZParameter': 2.}
+
+fit_workers = 1 # processes for the flux fits, more only helps for many spectra (see fluxFit)
+plot_diagnostics = None # None, 'pdf' or 'png' to write fit diagnostics to output_directory
+absorption_cache = os.path.join(output_directory, 'absorption_cache') # None recomputes every time
+geometry_cache = os.path.join(output_directory, 'geometry_cache') # None rebuilds the instrument every time
+multiple_scattering = True # also correct by the sample only MultipleScatteringCorrection
+trace_file = None # write a Chrome trace (json) of the time and memory of every algorithm call
+
+if trace_file is not None:
+    st.enable(trace_file)
+    st.instrument(globals(), ic, ac, vc)
+
 calibration_directory = '/SNS/{}/shared/calibration/'.format(instrument)
 
 file_directory = '/SNS/{}/IPTS-{}/nexus/'
 file_name = '{}_{}.nxs.h5'
 
-LoadEmptyInstrument(InstrumentName=instrument, OutputWorkspace=instrument)
+calibration_files = [os.path.join(calibration_directory, calibration)
+                     for calibration in [tube_calibration, detector_calibration] if calibration is not None]
+
+ic.geometry(instrument, instrument, calibrationFiles=calibration_files, cacheDir=geometry_cache)
 
 CreateGroupingWorkspace(InputWorkspace=instrument,
                         GroupDetectorsBy='bank',
@@ -47,184 +72,121 @@ if tubes_to_mask is not None:
 ExtractMask(InputWorkspace=instrument,
             OutputWorkspace='mask')
 
-if tube_calibration is not None:
+files_to_load = '+'.join([os.path.join(file_directory.format(instrument,ipts), file_name.format(instrument,run_no)) for run_no in run_nos])
+bkg_file = os.path.join(file_directory.format(instrument,bkg_ipts), file_name.format(instrument,bkg_no)) 
 
-    LoadNexus(Filename=os.path.join(calibration_directory, tube_calibration),
-              OutputWorkspace='tube_table')
-    ApplyCalibration(Workspace=instrument, CalibrationTable='tube_table')
+rebin_param = '{},{},{}'.format(k_min,k_max,k_max)
 
-if detector_calibration is not None:
+k_step = (k_max-k_min)/500
 
-    ext = os.path.splitext(detector_calibration)[1]
-    if ext == '.xml':
-        LoadParameterFile(Workspace=instrument,
-                          Filename=os.path.join(calibration_directory, detector_calibration))
-    else:
-        LoadIsawDetCal(InputWorkspace=instrument,
-                       Filename=os.path.join(calibration_directory, detector_calibration))
+def load_compressed(filename, output_workspace):
 
-files_to_load = '+'.join([os.path.join(file_directory.format(instrument,ipts), file_name.format(instrument,run_no)) for run_no in run_nos])
-bkg_file = os.path.join(file_directory.format(instrument,bkg_ipts), file_name.format(instrument,bkg_no)) 
+    # load a run and compress its events onto the k binning so later runs
+    # and the background only ever add compressed events
 
-rebin_param = '{},{},{}'.format(k_min,k_max,k_max)
+    Load(Filename=filename,
+         OutputWorkspace=output_workspace,
+         FilterByTofMin=tof_min,
+         FilterByTofMax=tof_max)
+
+    ConvertUnits(InputWorkspace=output_workspace, OutputWorkspace=output_workspace, Target='Momentum')
+    CropWorkspace(InputWorkspace=output_workspace, OutputWorkspace=output_workspace, XMin=k_min, XMax=k_max)
+    CompressEvents(InputWorkspace=output_workspace, OutputWorkspace=output_workspace, Tolerance=k_step)
+
+if stream_runs:
+
+    # one run in memory at a time, the compressed sum is normalised by the
+    # summed proton charge afterwards as when loading all runs together
+
+    for i, run_no in enumerate(run_nos):
+        load_compressed(os.path.join(file_directory.format(instrument,ipts), file_name.format(instrument,run_no)), 'van_run')
+        if i == 0:
+            RenameWorkspace(InputWorkspace='van_run', OutputWorkspace='van')
+        else:
+            Plus(LHSWorkspace='van', RHSWorkspace='van_run', OutputWorkspace='van')
+            DeleteWorkspace(Workspace='van_run')
+
+    load_compressed(bkg_file, 'bkg')
 
-Load(Filename=files_to_load,
-     OutputWorkspace='van',
-     LoadMonitors=True,
-     FilterByTofMin=tof_min,
-     FilterByTofMax=tof_max)
+else:
+
+    Load(Filename=files_to_load,
+         OutputWorkspace='van',
+         LoadMonitors=True,
+         FilterByTofMin=tof_min,
+         FilterByTofMax=tof_max)
+
+    Load(Filename=bkg_file,
+         OutputWorkspace='bkg',
+         FilterByTofMin=tof_min,
+         FilterByTofMax=tof_max)
 
 SetSample(InputWorkspace='van',
-          Geometry={'Shape': 'Sphere', 'Radius': 0.2,'Center': [0.,0.,0.]},
-          Material={'ChemicalFormula': 'V', 'UnitCellVolume': 27.642, 'ZParameter': 2.})
+          Geometry=sample_geometry,
+          Material=sample_material)
 
 # vanadium = CrystalStructure('3.0278 3.0278 3.0278', 'I m -3 m', 'V 0 0 0 1.0 0.00605')
 
 NormaliseByCurrent(InputWorkspace='van',
                    OutputWorkspace='van')
 
-Load(Filename=bkg_file,
-     OutputWorkspace='bkg',
-     FilterByTofMin=tof_min,
-     FilterByTofMax=tof_max)
-
 NormaliseByCurrent(InputWorkspace='bkg',
                    OutputWorkspace='bkg')
 
 mtd['bkg'] *= bkg_scale
 
 Minus(LHSWorkspace='van', RHSWorkspace='bkg', OutputWorkspace='van')
+DeleteWorkspace(Workspace='bkg')
 
 MaskDetectors(Workspace='van', MaskedWorkspace='mask')
-ConvertUnits(InputWorkspace='van', OutputWorkspace='van', Target='Momentum')
-CropWorkspace(InputWorkspace='van', OutputWorkspace='van', XMin=k_min, XMax=k_max)
-Rebin(InputWorkspace='van', OutputWorkspace='van', Params='{},{},{}'.format(k_min,(k_max-k_min)/500, k_max))
-
-ConvertUnits(InputWorkspace='van', OutputWorkspace='van_corr', Target='Wavelength')
-#MonteCarloAbsorption(InputWorkspace='van_corr', OutputWorkspace='abs_corr')
-AbsorptionCorrection(InputWorkspace='van_corr', OutputWorkspace='abs_corr')
-#MultipleScatteringCorrection(InputWorkspace='van_corr', OutputWorkspace='mult_corr')
-Divide(LHSWorkspace='van_corr', RHSWorkspace='abs_corr', OutputWorkspace='van_corr')
-Divide(LHSWorkspace='van_corr', RHSWorkspace='mult_corr_sampleOnly', OutputWorkspace='van_corr')
-
-ConvertUnits(InputWorkspace='van_corr', OutputWorkspace='van_corr', Target='Momentum')
-ConvertUnits(InputWorkspace='abs_corr', OutputWorkspace='abs_corr', Target='Momentum')
+if not stream_runs:
+    ConvertUnits(InputWorkspace='van', OutputWorkspace='van', Target='Momentum')
+    CropWorkspace(InputWorkspace='van', OutputWorkspace='van', XMin=k_min, XMax=k_max)
+Rebin(InputWorkspace='van', OutputWorkspace='van', Params='{},{},{}'.format(k_min,k_step, k_max))
 
-Rebin(InputWorkspace='van_corr',
-      OutputWorkspace='sa',
-      Params=rebin_param,
-      PreserveEvents=False)
+vc.correct('van', 'group', sample_geometry, sample_material, rebin_param,
+           calibrationFiles=calibration_files, cacheDir=absorption_cache,
+           multipleScattering=multiple_scattering)
 
-GroupDetectors(InputWorkspace='van_corr',
-               CopyGroupingFromWorkspace='group',
-               OutputWorkspace='van_corr')
-
-GroupDetectors(InputWorkspace='van',
-               CopyGroupingFromWorkspace='group',
-               OutputWorkspace='van')
-
-RemoveMaskedSpectra(InputWorkspace='van', MaskedWorkspace='van', OutputWorkspace='van')
-RemoveMaskedSpectra(InputWorkspace='van_corr', MaskedWorkspace='van_corr', OutputWorkspace='van_corr')
-
-def flux(k, phi_0, lambda_0, C_epi, C_fast, alpha, beta):
-    therm = phi_0*(4*np.pi**2)/k**2*np.exp(-(4*np.pi**2)/(k**2*lambda_0**2))
-    epi = C_epi*k**3/(2*np.pi)**3
-    fast = C_fast*(2*np.pi)**alpha/k**alpha*np.exp(-(2*np.pi*beta)/k)
-    return therm+epi+fast
-
-def residuals(params, k, y, e):
-    return (flux(k, *params)-y)/e
-
-y = mtd['van'].extractY()
-x = mtd['van'].extractX()
-e = mtd['van'].extractE()
+y = mtd['van_bank'].extractY()
+x = mtd['van_bank'].extractX()
+e = mtd['van_bank'].extractE()
 
 k = (x[:,:-1]+x[:,1:])/2
 
-y_corr = mtd['van_corr'].extractY()
-x_corr = mtd['van_corr'].extractX()
-e_corr = mtd['van_corr'].extractE()
+y_corr = mtd['van_flux'].extractY()
+x_corr = mtd['van_flux'].extractX()
+e_corr = mtd['van_flux'].extractE()
 
-y_mult, y_abs = mtd['mult_corr_sampleOnly'].extractY(), mtd['abs_corr'].extractY()
-y_abs = mtd['abs_corr'].extractY()
-y_fact = y_mult*y_abs
+y_abs = mtd['corr_bank'].extractY()
 
 k_corr = (x_corr[:,:-1]+x_corr[:,1:])/2
 
-for i in range(k.shape[0]):
-
-    fig, ax = plt.subplots(2, 2, sharex='col', sharey='row')
-
-    x0 = [0, 0, 0, 0, 0, 0]
-    args = (k[i,:], y[i,:], e[i,:])
-
-    sol = scipy.optimize.least_squares(residuals,
-                                       x0=x0,
-                                       args=args,
-                                       loss='soft_l1')
-
-    phi_0, lambda_0, C_epi, C_fast, alpha, beta = sol.x
-
-    fit = flux(k[i,:], *sol.x)
-
-    ax[0,0].errorbar(k[i,:], y[i,:]/y[i,:].max(), e[i,:]/y[i,:].max(), fmt='.', label='orig')
-    ax[0,0].plot(k[i,:], fit/y[i,:].max(), '-', label='orig')
-    ax[0,1].errorbar(2*np.pi/k[i,:], y[i,:]/y[i,:].max(), e[i,:]/y[i,:].max(), fmt='.', label='orig')
-    ax[0,1].plot(2*np.pi/k[i,:], fit/y[i,:].max(), '-', label='orig')
+with st.stage('flux fitting', spectra=k.shape[0]):
+    params = ff.fitSpectra(k, y, e, nWorkers=fit_workers)
+    params_corr = ff.fitSpectra(k_corr, y_corr, e_corr, nWorkers=fit_workers)
 
-    x0 = [0, 0, 0, 0, 0, 0]
-    args = (k_corr[i,:], y_corr[i,:], e_corr[i,:])
+fit = ff.flux(k, *params.T[:,:,None])
+fit_corr = ff.flux(k_corr, *params_corr.T[:,:,None])
 
-    sol = scipy.optimize.least_squares(residuals,
-                                       x0=x0,
-                                       args=args,
-                                       loss='soft_l1')
+report = None
+if plot_diagnostics is not None:
+    report = fr.start(os.path.join(output_directory, 'flux_fits.pdf'),
+                      plot_diagnostics,
+                      k=k, y=y, e=e, fit=fit,
+                      k_corr=k_corr, y_corr=y_corr, e_corr=e_corr, fit_corr=fit_corr,
+                      y_abs=y_abs)
 
-    phi_0, lambda_0, C_epi, C_fast, alpha, beta = sol.x
+vc.integrateFlux('van_flux', 'flux', k_min, k_max)
 
-    fit = flux(k_corr[i,:], *sol.x)
-
-    ax[0,0].errorbar(k_corr[i,:], y_corr[i,:]/y_corr[i,:].max(), e_corr[i,:]/y_corr[i,:].max(), fmt='.', label='corr')
-    ax[0,0].plot(k_corr[i,:], fit/y_corr[i,:].max(), '-', label='corr')
-    ax[0,1].errorbar(2*np.pi/k_corr[i,:], y_corr[i,:]/y_corr[i,:].max(), e_corr[i,:]/y_corr[i,:].max(), fmt='.', label='corr')
-    ax[0,1].plot(2*np.pi/k_corr[i,:], fit/y_corr[i,:].max(), '-', label='corr')
-
-    ax[1,0].plot(k_corr[i,:], 1/y_abs[i,:]*y_abs[i,:].max(), '-', label='abs')
-    #ax[1,0].plot(k_corr[i,:], 1/y_mult[i,:]*y_mult[i,:].max(), '-', label='mult')
-    #ax[1,0].plot(k_corr[i,:], 1/y_fact[i,:]*y_fact[i,:].max(), '-', label='corr')
-
-    ax[1,1].plot(2*np.pi/k_corr[i,:], 1/y_abs[i,:]*y_abs[i,:].max(), '-', label='abs')
-    #ax[1,1].plot(2*np.pi/k_corr[i,:], 1/y_mult[i,:]*y_mult[i,:].max(), '-', label='mult')
-    #ax[1,1].plot(2*np.pi/k_corr[i,:], 1/y_fact[i,:]*y_fact[i,:].max(), '-', label='corr')
-
-    ax[1,0].legend()
-    ax[1,1].legend()
-
-    ax[1,0].set_xlabel('$k$ [$\AA^{-1}$]')
-    ax[1,1].set_xlabel('$\lambda$ [$\AA$]')
-    ax[0,0].axvline(2*np.pi/0.75, color='k', linestyle='--')
-    ax[1,0].axvline(2*np.pi/0.75, color='k', linestyle='--')
-    ax[0,1].axvline(0.75, color='k', linestyle='--')
-    ax[1,1].axvline(0.75, color='k', linestyle='--')
-    ax[0,0].legend()
-    ax[0,1].legend()
-    fig.show()
-
-plt.close('all')
-
-Rebin(InputWorkspace='van_corr',
-      OutputWorkspace='van_flux',
-      Params=rebin_param)
-
-flux = mtd['van_flux']
-for i in range(flux.getNumberHistograms()):
-    el=flux.getSpectrum(i)
-    if flux.readY(i)[0] > 0:
-        el.divide(flux.readY(i)[0],flux.readE(i)[0])
+SaveNexus(InputWorkspace='sa', Filename=os.path.join(output_directory, 'solid_angle.nxs'))
+SaveNexus(InputWorkspace='flux', Filename=os.path.join(output_directory, 'flux.nxs'))
 
-SortEvents(InputWorkspace='van_flux', SortBy='X Value')
+# memory mappable copies for lookups without loading the NeXus files
+ns.writeWorkspace(os.path.join(output_directory, 'solid_angle.bin'), 'sa', 'sa')
+ns.writeWorkspace(os.path.join(output_directory, 'flux.bin'), 'flux', 'flux', cumulative=True)
 
-IntegrateFlux(InputWorkspace='van_flux', OutputWorkspace='flux', NPoints=1000)
+if report is not None:
+    report.join()
 
-SaveNexus(InputWorkspace='sa', Filename=os.path.join(output_directory, 'solid_angle.nxs'))
-SaveNexus(InputWorkspace='flux', Filename=os.path.join(output_directory, 'flux.nxs'))
\ No newline at end of file
+st.write()
@@ -0,0 +1,86 @@
+# vanadium correction chain used by vanadium.py (and benchmark.py)
+# correct() takes background subtracted, masked vanadium events on the k
+# binning and produces the solid angle (sa), the per bank uncorrected and
+# corrected spectra for the flux fits and the per bank correction factors.
+# integrateFlux() turns the corrected per bank spectra into the cumulative
+# flux used by MDNorm.
+from mantid.simpleapi import *
+import numpy as np
+
+import absorptionCache as ac
+import stageTrace as st
+
+def correct(inputWorkspace, groupingWorkspace, geometry, material, rebinParams,
+            calibrationFiles=[], cacheDir=None, multipleScattering=False):
+
+    # inputWorkspace is consumed, the outputs are sa (one bin of rebinParams
+    # per pixel), van_bank (uncorrected), van_flux (corrected) and corr_bank
+    # (average correction factor) grouped by groupingWorkspace
+
+    # the uncorrected spectra are only needed per bank for the fits, so they
+    # are taken first as small histograms
+    GroupDetectors(InputWorkspace=inputWorkspace,
+                   CopyGroupingFromWorkspace=groupingWorkspace,
+                   PreserveEvents=False,
+                   OutputWorkspace='van_bank')
+
+    # fused corrections: the absorption (and multiple scattering) factors are
+    # made directly on the momentum bins of the input (lambda = 2pi/k so no
+    # conversion of the data to wavelength and back is needed) and the input
+    # is corrected in place. corr is the only full size intermediate and is
+    # dropped as soon as it's applied
+    with st.stage('corrections'):
+        with st.stage('absorption'):
+            ac.absorptionCorrection(inputWorkspace, 'corr', geometry, material,
+                                    calibrationFiles=calibrationFiles, cacheDir=cacheDir,
+                                    multipleScattering=multipleScattering)
+
+        GroupDetectors(InputWorkspace='corr',
+                       CopyGroupingFromWorkspace=groupingWorkspace,
+                       Behaviour='Average',
+                       OutputWorkspace='corr_bank')
+
+        Divide(LHSWorkspace=inputWorkspace, RHSWorkspace='corr', OutputWorkspace=inputWorkspace)
+        DeleteWorkspace(Workspace='corr')
+
+    Rebin(InputWorkspace=inputWorkspace,
+          OutputWorkspace='sa',
+          Params=rebinParams,
+          PreserveEvents=False)
+
+    # the corrected data is only needed per bank on the k binning from here,
+    # grouped into a small histogram (no copy of the events) before the per
+    # pixel events are dropped
+    GroupDetectors(InputWorkspace=inputWorkspace,
+                   CopyGroupingFromWorkspace=groupingWorkspace,
+                   PreserveEvents=False,
+                   OutputWorkspace='van_flux')
+    DeleteWorkspace(Workspace=inputWorkspace)
+
+    RemoveMaskedSpectra(InputWorkspace='corr_bank', MaskedWorkspace='van_bank', OutputWorkspace='corr_bank')
+    RemoveMaskedSpectra(InputWorkspace='van_bank', MaskedWorkspace='van_bank', OutputWorkspace='van_bank')
+    RemoveMaskedSpectra(InputWorkspace='van_flux', MaskedWorkspace='van_flux', OutputWorkspace='van_flux')
+
+def integrateFlux(inputWorkspace, outputWorkspace, k_min, k_max):
+
+    # cumulative flux of each spectrum of the histogram inputWorkspace (e.g.
+    # van_flux), normalised to 1 over k_min to k_max
+
+    # normalise each spectrum by its total in one operation, spectra that are
+    # zero, masked or nan are divided by 1 +/- 0 i.e. left as they are
+    y_norm = mtd[inputWorkspace].extractY().sum(axis=1)
+    e_norm = np.sqrt((mtd[inputWorkspace].extractE()**2).sum(axis=1))
+    valid = y_norm > 0
+
+    CreateWorkspace(DataX=np.tile([k_min, k_max], len(y_norm)),
+                    DataY=np.where(valid, y_norm, 1.0),
+                    DataE=np.where(valid, e_norm, 0.0),
+                    NSpec=len(y_norm),
+                    UnitX='Momentum',
+                    ParentWorkspace=inputWorkspace,
+                    OutputWorkspace='van_norm')
+
+    Divide(LHSWorkspace=inputWorkspace, RHSWorkspace='van_norm', OutputWorkspace=inputWorkspace)
+    DeleteWorkspace(Workspace='van_norm')
+
+    IntegrateFlux(InputWorkspace=inputWorkspace, OutputWorkspace=outputWorkspace, NPoints=1000)